@@ -1,7 +1,21 @@
+import asyncio
+import json
+import mimetypes
+import os
+import uuid
+
 import fastapi
-from config import config
+from config import AnnotationFormat, config
 from fastapi import HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from helpers.analysis_cache import analysis_cache
+from helpers.derivatives import derivatives
+from helpers.download_jobs import DownloadJobState, download_jobs
+from helpers.tile_cache import tile_cache
+from helpers.tile_fetcher import tile_fetcher
+from helpers.upload_encoder import upload_encoder
+from helpers.version_resolver import version_resolver
 from main import SatelliteBackend
 
 app = fastapi.FastAPI()
@@ -25,11 +39,22 @@ async def startup_event():
     try:
         config.validate()
         print(f"✅ Backend started with analyzer: {config.ANALYZER_TYPE.value}")
+        # resolve the current imagery versions, waiting for them (briefly)
+        # only if none are known yet, so downloads don't start out outdated
+        await asyncio.to_thread(version_resolver.warm_up, config.VERSION_STARTUP_TIMEOUT)
     except ValueError as e:
         print(f"❌ Configuration error: {e}")
         raise
 
 
+@app.on_event("shutdown")
+def shutdown_event():
+    """
+    Close pooled tile connections.
+    """
+    tile_fetcher.close()
+
+
 def validate_coordinates(latitude: float, longitude: float) -> None:
     """
     Validate latitude and longitude coordinates.
@@ -59,23 +84,112 @@ def validate_coordinates(latitude: float, longitude: float) -> None:
         )
 
 
+IMAGE_FORMATS = ("base64", "urls", "multipart")
+
+IMAGE_FORMAT_QUERY = fastapi.Query(
+    default=None,
+    description="How to deliver images: base64 (inline JSON, default), urls (links to the files) or multipart (raw files)"
+)
+
+
+def negotiate_image_format(request: fastapi.Request, format: str = None, default: str = "base64") -> str:
+    """
+    Pick how to deliver images: as requested explicitly, or as multipart if
+    the client accepts it, or else by default as base64 in JSON, which is
+    what existing clients expect.
+    """
+    if format is None:
+        format = "multipart" if "multipart/mixed" in request.headers.get("accept", "") else default
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid image format: {format}. Use one of {', '.join(IMAGE_FORMATS)}."
+        )
+    return format
+
+
+def images_response(request: fastapi.Request, image_id: str, format: str):
+    """
+    Deliver the saved images of an image_id, oldest version first, without
+    encoding them again.
+    """
+    if format == "base64":
+        return {
+            "image_id": image_id,
+            "images": satellite_backend.encoded_images(image_id)
+        }
+
+    entries = satellite_backend.image_store.entries(image_id)
+    if format == "urls":
+        def url(entry):
+            return request.url_for("get_image", image_id=image_id, name=entry["name"])
+
+        return {
+            "image_id": image_id,
+            "images": [{
+                "url": str(url(entry)),
+                "thumbnail_url": str(url(entry).include_query_params(size=derivatives.sizes[0])),
+                "name": entry["name"],
+                "version": entry["version"],
+                "width": entry["width"],
+                "height": entry["height"],
+            } for entry in entries]
+        }
+
+    boundary = uuid.uuid4().hex
+
+    def parts():
+        for entry in entries:
+            media_type = mimetypes.guess_type(entry["name"])[0] or "application/octet-stream"
+            yield (
+                f"--{boundary}\r\n"
+                f"Content-Type: {media_type}\r\n"
+                f"Content-Disposition: inline; filename=\"{entry['name']}\"\r\n"
+                f"Content-Length: {os.path.getsize(entry['path'])}\r\n"
+                f"X-Image-Version: {entry['version']}\r\n\r\n"
+            ).encode("utf-8")
+            with open(entry["path"], "rb") as f:
+                while chunk := f.read(64 * 1024):
+                    yield chunk
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode("utf-8")
+
+    return StreamingResponse(
+        parts(),
+        media_type=f"multipart/mixed; boundary={boundary}",
+        headers={"X-Image-Id": image_id},
+    )
+
+
 @app.get("/")
 def home():
     return {
         "message": "Satellite Analysis API",
         "analyzer": config.ANALYZER_TYPE.value,
-        "status": "ready"
+        "status": "ready",
+        "tile_cache": tile_cache.stats(),
+        "tile_fetcher": tile_fetcher.stats(),
+        "download_jobs": download_jobs.stats(),
+        "analyses": satellite_backend.analyses.stats(),
+        "image_store": satellite_backend.image_store.stats(),
+        "derivatives": derivatives.stats(),
+        "analysis_cache": analysis_cache.stats(),
+        "upload_encoder": upload_encoder.stats(),
+        "analyzer_stats": satellite_backend.satellite_analyzer.stats(),
     }
 
 
 @app.get("/downloadSatelliteImages")
 def download_satellite_images(
+    request: fastapi.Request,
     latitude: float = fastapi.Query(..., description="Latitude coordinate (-90 to 90)"),
     longitude: float = fastapi.Query(..., description="Longitude coordinate (-180 to 180)"),
-    zoom: int = fastapi.Query(default=10, description="Zoom level")
+    zoom: int = fastapi.Query(default=10, description="Zoom level"),
+    format: str = IMAGE_FORMAT_QUERY,
 ):
     """
-    Download satellite images for given coordinates.
+    Download satellite images for given coordinates, delivered as base64 in
+    JSON, as URLs to the saved files or as raw multipart (see `format`).
     
     Validates coordinates before processing:
     - Rejects (0, 0) as it's typically an error
@@ -84,24 +198,224 @@ def download_satellite_images(
     """
     # Validate coordinates
     validate_coordinates(latitude, longitude)
+    format = negotiate_image_format(request, format)
     
     print(f"✅ Downloading satellite images for {latitude}, {longitude} with zoom {zoom}")
 
-    return satellite_backend.download_satellite_images(latitude, longitude, zoom)
+    # identical concurrent requests share one download job
+    job = satellite_backend.submit_download(latitude, longitude, zoom)
+    while not job.wait(timeout=10):
+        job.touch()
+
+    if job.state != DownloadJobState.DONE:
+        raise HTTPException(status_code=500, detail=f"Download {job.state}: {job.error}")
+    return images_response(request, job.result["image_id"], format)
+
+
+@app.get("/downloadSatelliteImages/stream")
+def stream_satellite_images(
+    request: fastapi.Request,
+    latitude: float = fastapi.Query(..., description="Latitude coordinate (-90 to 90)"),
+    longitude: float = fastapi.Query(..., description="Longitude coordinate (-180 to 180)"),
+    zoom: int = fastapi.Query(default=10, description="Zoom level"),
+    format: str = fastapi.Query(default=None, description="Stream format: sse or ndjson (defaults by Accept header)"),
+):
+    """
+    Download satellite images for given coordinates, streaming each version's
+    image (with its version, tile range and zoom) as soon as it's saved,
+    either as Server-Sent Events or as newline-delimited JSON. Disconnecting
+    cancels the download.
+    """
+    validate_coordinates(latitude, longitude)
+
+    if format is None:
+        format = "sse" if "text/event-stream" in request.headers.get("accept", "") else "ndjson"
+    if format not in ("sse", "ndjson"):
+        raise HTTPException(status_code=400, detail=f"Invalid stream format: {format}. Use sse or ndjson.")
+
+    print(f"✅ Streaming satellite images for {latitude}, {longitude} with zoom {zoom} as {format}")
+
+    async def frames():
+        async for event in satellite_backend.stream_satellite_images(latitude, longitude, zoom):
+            if format == "sse":
+                data = {key: value for key, value in event.items() if key != "event"}
+                yield f"event: {event['event']}\ndata: {json.dumps(data)}\n\n"
+            else:
+                yield json.dumps(event) + "\n"
+
+    return StreamingResponse(
+        frames(),
+        media_type="text/event-stream" if format == "sse" else "application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/downloadSatelliteImages/jobs", status_code=202)
+def submit_download_job(
+    latitude: float = fastapi.Query(..., description="Latitude coordinate (-90 to 90)"),
+    longitude: float = fastapi.Query(..., description="Longitude coordinate (-180 to 180)"),
+    zoom: int = fastapi.Query(default=10, description="Zoom level")
+):
+    """
+    Start downloading satellite images in the background and return the job
+    right away, to be polled for progress and, once done, its result. If the
+    same area is already being downloaded, that job is returned instead.
+    """
+    validate_coordinates(latitude, longitude)
+
+    job = satellite_backend.submit_download(latitude, longitude, zoom)
+    print(f"✅ Submitted download job {job.id} for {latitude}, {longitude} with zoom {zoom}")
+
+    return job.to_dict()
+
+
+def get_download_job(job_id: str):
+    job = download_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown download job: {job_id}")
+    return job
+
+
+@app.get("/downloadSatelliteImages/jobs/{job_id}")
+def download_job_status(job_id: str):
+    """
+    Report the state of a download job, including its progress through the
+    versions found and through the tiles of the version being downloaded.
+    """
+    return get_download_job(job_id).to_dict()
+
+
+@app.get("/downloadSatelliteImages/jobs/{job_id}/result")
+def download_job_result(request: fastapi.Request, job_id: str, format: str = IMAGE_FORMAT_QUERY):
+    """
+    Return the result of a finished download job, in the same formats as
+    /downloadSatelliteImages.
+    """
+    format = negotiate_image_format(request, format)
+    job = get_download_job(job_id)
+    if job.state == DownloadJobState.FAILED:
+        raise HTTPException(status_code=500, detail=f"Download job failed: {job.error}")
+    if job.state != DownloadJobState.DONE:
+        raise HTTPException(status_code=409, detail=f"Download job is {job.state}")
+    return images_response(request, job.result["image_id"], format)
+
+
+@app.delete("/downloadSatelliteImages/jobs/{job_id}")
+def cancel_download_job(job_id: str):
+    """
+    Cancel a download job, which stops fetching tiles within a fraction of a
+    second and discards the images saved so far.
+    """
+    job = download_jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown download job: {job_id}")
+    return job.to_dict()
+
+
+@app.get("/images/{image_id}")
+def list_images(request: fastapi.Request, image_id: str, format: str = IMAGE_FORMAT_QUERY):
+    """
+    Deliver the images previously downloaded under an image_id, as URLs to
+    the saved files by default.
+    """
+    if image_id not in satellite_backend.image_store:
+        raise HTTPException(status_code=404, detail=f"Unknown image_id: {image_id}")
+    return images_response(request, image_id, negotiate_image_format(request, format, default="urls"))
+
+
+IMAGE_SIZE_QUERY = fastapi.Query(
+    default=None,
+    gt=0,
+    description="Longest side (in pixels) the image is needed at; serves the smallest WebP preview at least this large, if there's one",
+)
+
+
+@app.get("/images/{image_id}/{name}", name="get_image")
+def get_image(request: fastapi.Request, image_id: str, name: str, size: int = IMAGE_SIZE_QUERY):
+    """
+    Serve a saved image file as is (sent with sendfile where available), with
+    ETag and Range support, or one of its previews given a `size`. Saved
+    images never change, so they're cacheable for good.
+    """
+    path = satellite_backend.image_store.path(image_id, name)
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Unknown image: {image_id}/{name}")
+
+    return file_response(request, path, "public, max-age=31536000, immutable", size)
+
+
+@app.get("/processedImages/{image_id}/{name}", name="get_processed_image")
+def get_processed_image(request: fastapi.Request, image_id: str, name: str, size: int = IMAGE_SIZE_QUERY):
+    """
+    Serve an annotated image as saved by an analysis, like /images. These get
+    replaced when analyzing again, so clients need to revalidate them.
+    """
+    path = os.path.join(config.PROCESSED_DATA_DIR, image_id, name)
+    if image_id not in satellite_backend.image_store or name != os.path.basename(name) \
+            or name.startswith(".") or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Unknown processed image: {image_id}/{name}")
+
+    return file_response(request, path, "no-cache", size)
+
+
+def file_response(request: fastapi.Request, path: str, cache_control: str, size: int = None):
+    """
+    Serve a file with FileResponse (i.e. sendfile where available, and Range
+    support), answering conditional requests matching its ETag with a 304.
+    Given a `size`, an image's best fitting derivative is served instead (or
+    the image itself until it's generated, see `Derivatives.best`, which
+    mustn't be cached in its place).
+    """
+    if size is not None:
+        path, pending = derivatives.best(path, size)
+        if pending:
+            cache_control = "no-cache"
+    response = FileResponse(path, stat_result=os.stat(path), headers={"Cache-Control": cache_control})
+    etag = response.headers["etag"]
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+    return response
 
 
 @app.get("/analyzeSatelliteImages")
 async def analyze_satellite_images(
+    request: fastapi.Request,
     image_id: str = fastapi.Query(..., description="Image ID to analyze"),
     analysis_type: str = fastapi.Query(default="basic", description="Type of object to detect"),
+    image_format: AnnotationFormat = fastapi.Query(default=None, description="Encoding of the annotated images: png, webp or jpeg (defaults to ANNOTATION_FORMAT)"),
+    format: str = fastapi.Query(default="base64", description="How to deliver annotated images: base64 (inline JSON) or urls (links to the files)"),
 ):
     """
     Analyze satellite images using configured analyzer (Replicate or local).
     """
+    if format not in ("base64", "urls"):
+        raise HTTPException(status_code=400, detail=f"Invalid image format: {format}. Use base64 or urls.")
+
     print(f"Analyzing images {image_id} for {analysis_type}")
     
-    return await satellite_backend.analyze_satellite_images(image_id, analysis_type)
+    analysis = await satellite_backend.analyze_satellite_images(image_id, analysis_type, image_format)
+
+    image_url = None
+    if format == "urls":
+        def image_url(path):
+            return str(request.url_for("get_processed_image", image_id=image_id, name=os.path.basename(path)))
+    return satellite_backend.analysis_response(analysis, image_url)
+
+
 
+@app.delete("/analysisCache")
+def invalidate_analysis_cache(
+    model: str = fastapi.Query(default=None, description="Model version whose cached detections to drop (defaults to all)"),
+):
+    """
+    Drop cached detections, e.g. after changing a model's weights without
+    changing its version, along with the analysis results reused for
+    repeated requests, which were derived from them.
+    """
+    return {
+        "dropped": analysis_cache.invalidate(model),
+        "dropped_results": satellite_backend.analyses.clear(),
+    }
 
 if __name__ == "__main__":
     import uvicorn
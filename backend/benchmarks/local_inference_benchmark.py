@@ -0,0 +1,94 @@
+"""
+Measures the local analyzer's throughput (images/sec) and peak memory (RSS)
+on CPU, with the fp32 model versus dynamically int8-quantized, one image per
+forward pass versus batched. Every variant runs in a process of its own, so
+that neither peak memory nor thread settings carry over. Requires torch and
+transformers (and downloads the model once).
+
+Usage (from the backend directory):
+    python -m benchmarks.local_inference_benchmark [--images 8] [--size 1024] [--batch-size 4] [--intra-op-threads 0] [--inter-op-threads 0]
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+
+def run_variant(quantization, batch_size, args, results):
+    # the helpers set up their singletons from the config on import, and
+    # cached detections would skip inference altogether
+    os.environ["DATA_DIR"] = args.data_dir
+    os.environ["ANALYSIS_CACHE_MAX_ENTRIES"] = "0"
+    os.environ["ANALYSIS_TILE_SIZE"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from PIL import Image
+
+    from config import LocalDevice, LocalQuantization
+    from helpers.satellite_analyzer import SatelliteAnalyzer
+
+    start = time.perf_counter()
+    analyzer = SatelliteAnalyzer(
+        device=LocalDevice.CPU,
+        quantization=LocalQuantization(quantization),
+        intra_op_threads=args.intra_op_threads,
+        inter_op_threads=args.inter_op_threads,
+        batch_size=batch_size,
+    )
+    load_seconds = time.perf_counter() - start
+
+    images = [Image.new("RGB", (args.size, args.size), (40, 90 + i, 40)) for i in range(args.images)]
+    # the first forward pass includes one-off setup costs
+    analyzer.detect_windows(images[:1], "car")
+
+    start = time.perf_counter()
+    analyzer.detect_windows(images, "car")
+    elapsed = time.perf_counter() - start
+
+    results.put({
+        "quantization": quantization,
+        "batch_size": analyzer.batch_size,
+        "load_seconds": load_seconds,
+        "images_per_second": args.images / elapsed,
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--intra-op-threads", type=int, default=0)
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as data_dir:
+        args.data_dir = data_dir
+        print(f"Analyzing {args.images} images of {args.size}x{args.size} on CPU...")
+        print(f"{'model':<8} {'batch':>6} {'load':>8} {'images/s':>10} {'peak RSS':>10}")
+        for quantization in ("none", "int8"):
+            for batch_size in sorted({1, args.batch_size}):
+                label = "fp32" if quantization == "none" else quantization
+                results = context.Queue()
+                process = context.Process(target=run_variant, args=(quantization, batch_size, args, results))
+                process.start()
+                process.join()
+                if process.exitcode != 0:
+                    print(f"{label:<8} {batch_size:>6} failed (exit code {process.exitcode})")
+                    continue
+
+                result = results.get()
+                print(
+                    f"{label:<8} {result['batch_size']:>6} {result['load_seconds']:7.1f}s "
+                    f"{result['images_per_second']:10.2f} {result['peak_rss_mb']:8.0f}MB"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+A local stand-in for the Replicate predictions API, for testing and
+benchmarking the Replicate analyzer without an API token or costs. Predictions
+take `--latency` seconds, return a few made-up Grounding DINO detections
+(the same ones for the same image), fail at `--failure-rate`, and more than
+`--rate` prediction requests per second are rejected with 429, like Replicate
+does. Images can be passed inline or uploaded to its files API.
+
+Usage (from the backend directory):
+    python -m benchmarks.mock_replicate [--port 8703] [--latency 1.0] [--rate 10] [--failure-rate 0]
+
+and point the backend at it with REPLICATE_BASE_URL=http://127.0.0.1:8703
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+import fastapi
+from fastapi.responses import JSONResponse
+
+
+def create_app(latency=1.0, rate=10.0, failure_rate=0.0):
+    app = fastapi.FastAPI()
+    app.state.predictions = {}
+    app.state.requests = deque()
+    app.state.files = {}
+    app.state.stats = {
+        "created": 0, "rate_limited": 0, "failed": 0, "in_flight": 0, "max_in_flight": 0,
+        "uploaded_files": 0, "uploaded_bytes": 0,
+    }
+
+    def detections(image):
+        rng = random.Random(hashlib.sha256(image.encode("utf-8")).digest())
+        found = []
+        for _ in range(rng.randint(0, 8)):
+            x, y = rng.uniform(0, 0.9), rng.uniform(0, 0.9)
+            found.append({
+                "bbox": [x, y, x + rng.uniform(0.02, 0.1), y + rng.uniform(0.02, 0.1)],
+                "label": "object",
+                "confidence": rng.uniform(0.2, 1.0),
+            })
+        return found
+
+    def prediction(id):
+        state = app.state.predictions[id]
+        done = time.monotonic() >= state["done_at"]
+        status = ("failed" if state["fails"] else "succeeded") if done else "processing"
+        return {
+            "id": id,
+            "model": "mock/grounding-dino",
+            "version": state["version"],
+            "status": status,
+            "input": {},
+            "output": {"detections": state["detections"], "result_image": None} if status == "succeeded" else None,
+            "logs": "",
+            "error": "mock prediction failure" if status == "failed" else None,
+            "metrics": {"predict_time": latency} if done else None,
+            "created_at": state["created_at"],
+            "started_at": state["created_at"],
+            "completed_at": datetime.now(timezone.utc).isoformat() if done else None,
+            "urls": {"get": f"/v1/predictions/{id}", "cancel": f"/v1/predictions/{id}/cancel"},
+        }
+
+    @app.post("/v1/predictions", status_code=201)
+    async def create_prediction(request: fastapi.Request):
+        now = time.monotonic()
+        while app.state.requests and now - app.state.requests[0] >= 1:
+            app.state.requests.popleft()
+        if rate and len(app.state.requests) >= rate:
+            app.state.stats["rate_limited"] += 1
+            return JSONResponse({"title": "Request was throttled", "detail": "Request was throttled.", "status": 429}, status_code=429)
+        app.state.requests.append(now)
+
+        body = await request.json()
+        app.state.stats["uploaded_bytes"] += len(str(body.get("input", {}).get("image", "")))
+        id = uuid.uuid4().hex
+        fails = random.random() < failure_rate
+        app.state.predictions[id] = {
+            "version": body.get("version", ""),
+            "detections": detections(str(body.get("input", {}).get("image", ""))),
+            "fails": fails,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "done_at": now + latency,
+        }
+        app.state.stats["created"] += 1
+        app.state.stats["failed"] += fails
+
+        # "Prefer: wait" holds the response until the prediction is done
+        if request.headers.get("prefer", "").startswith("wait"):
+            stats = app.state.stats
+            stats["in_flight"] += 1
+            stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+            try:
+                await asyncio.sleep(latency)
+            finally:
+                stats["in_flight"] -= 1
+        return prediction(id)
+
+    @app.post("/v1/files", status_code=201)
+    async def create_file(request: fastapi.Request):
+        # the multipart body isn't parsed, it only counts towards the stats
+        body = await request.body()
+        id = uuid.uuid4().hex
+        app.state.files[id] = len(body)
+        app.state.stats["uploaded_files"] += 1
+        app.state.stats["uploaded_bytes"] += len(body)
+        now = datetime.now(timezone.utc)
+        return {
+            "id": id,
+            "name": "upload",
+            "content_type": "application/octet-stream",
+            "size": len(body),
+            "etag": id,
+            "checksums": {},
+            "metadata": {},
+            "created_at": now.isoformat(),
+            "expires_at": (now + timedelta(days=1)).isoformat(),
+            "urls": {"get": f"{request.base_url}v1/files/{id}/download"},
+        }
+
+    @app.get("/v1/models/{owner}/{name}/versions/{id}")
+    def get_version(owner: str, name: str, id: str):
+        # the client looks up the version of an "owner/name:version" reference
+        return {
+            "id": id,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "cog_version": "0.9.0",
+            "openapi_schema": {"components": {"schemas": {"Output": {"type": "object"}}}},
+        }
+
+    @app.get("/v1/predictions/{id}")
+    def get_prediction(id: str):
+        if id not in app.state.predictions:
+            return JSONResponse({"detail": "Not found.", "status": 404}, status_code=404)
+        return prediction(id)
+
+    @app.get("/stats")
+    def stats():
+        return app.state.stats
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8703)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--rate", type=float, default=10.0)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    import uvicorn
+    uvicorn.run(create_app(args.latency, args.rate, args.failure_rate), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Measures the wall time of analyzing a version history via Replicate, one
+image at a time (as the analyzer used to) versus fanned out, against the mock
+Replicate API (see benchmarks/mock_replicate.py) run in-process.
+
+Usage (from the backend directory):
+    python -m benchmarks.replicate_fanout_benchmark [--images 12] [--latency 1.0] [--concurrency 4]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+
+def serve(app, port):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=12)
+    parser.add_argument("--latency", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=10.0)
+    parser.add_argument("--port", type=int, default=8703)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        # the helpers set up their singletons from the config on import, and
+        # cached detections would skip the API altogether
+        os.environ["DATA_DIR"] = data_dir
+        os.environ["PROCESSED_DATA_DIR"] = os.path.join(data_dir, "processed")
+        os.environ["ANALYSIS_CACHE_MAX_ENTRIES"] = "0"
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from benchmarks.mock_replicate import create_app
+        from helpers.replicate_analyzer import ReplicateAnalyzer
+
+        server = serve(create_app(args.latency, args.rate), args.port)
+        base_url = f"http://127.0.0.1:{args.port}"
+
+        images = [Image.new("RGB", (512, 512), (40, 90 + i, 40)) for i in range(args.images)]
+        names = [f"v{900 - i}.jpg" for i in range(args.images)]
+
+        def run(label, concurrency):
+            analyzer = ReplicateAnalyzer("mock", base_url, max_concurrency=concurrency, requests_per_second=args.rate, burst=int(args.rate))
+            start = time.perf_counter()
+            results = asyncio.run(analyzer.analyze_images(images, "car", "benchmark", names))
+            elapsed = time.perf_counter() - start
+            failed = sum("error" in result for result in results)
+            print(f"{label:<34} {elapsed:8.3f}s ({failed} failed)")
+
+        print(f"Analyzing {args.images} images at {args.latency}s per prediction...")
+        run("one at a time (before)", 1)
+        run(f"fanned out ({args.concurrency} concurrent)", args.concurrency)
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
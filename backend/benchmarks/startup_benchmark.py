@@ -0,0 +1,82 @@
+"""
+Measures backend startup time against a synthetic data directory with tens of
+thousands of downloaded images: walking the directory and opening every image
+(as startup used to, minus keeping the files open), building the image
+manifest from it (once, on the first start after upgrading) and loading the
+manifest (every start after that).
+
+Usage (from the backend directory):
+    python -m benchmarks.startup_benchmark [--image-ids 20000] [--files-per-id 3]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+from PIL import Image
+
+
+def populate(data_dir, image_ids, files_per_id):
+    """Fills `data_dir` with tiny JPEGs named the way the downloader does."""
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (16, 16), (40, 90, 40)).save(buffer, format="JPEG")
+    data = buffer.getvalue()
+
+    for _ in range(image_ids):
+        image_dir = os.path.join(data_dir, str(uuid.uuid4()))
+        os.makedirs(image_dir)
+        for version in range(files_per_id):
+            name = f"googlemapsat88mph-2024-01-01T00.00.00-downward-v{900 - version}-x1..2y3..4-z20-52.3,4.76-200x200m.jpg"
+            with open(os.path.join(image_dir, name), "wb") as f:
+                f.write(data)
+
+
+def timed(label, fn):
+    start = time.perf_counter()
+    result = fn()
+    print(f"{label:<34} {time.perf_counter() - start:8.3f}s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--image-ids", type=int, default=20000)
+    parser.add_argument("--files-per-id", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        # the helpers set up their singletons from the config on import
+        os.environ["DATA_DIR"] = data_dir
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from helpers.image_manifest import ImageManifest
+        from helpers.image_store import ImageStore
+
+        print(f"Populating {data_dir} with {args.image_ids} image ids x {args.files_per_id} files...")
+        populate(data_dir, args.image_ids, args.files_per_id)
+
+        def scan():
+            images = {}
+            for entry in os.scandir(data_dir):
+                if entry.is_dir() and not entry.name.startswith("."):
+                    images[entry.name] = []
+                    for f in os.scandir(entry.path):
+                        with Image.open(f.path) as image:
+                            images[entry.name].append(image.size)
+            return images
+
+        timed("walk and open (before manifest)", scan)
+
+        manifest_path = os.path.join(data_dir, ".benchmark.sqlite3")
+        timed("first start (building manifest)", lambda: ImageStore(data_dir, 0, ImageManifest(manifest_path)))
+        store = timed("start (loading manifest)", lambda: ImageStore(data_dir, 0, ImageManifest(manifest_path)))
+
+        assert len(store.ids()) == args.image_ids
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import os
+import random
 from enum import Enum
 
 
@@ -8,6 +9,125 @@ class AnalyzerType(str, Enum):
     LOCAL = "local"
 
 
+class LocalDevice(str, Enum):
+    """Available devices for the local analyzer ("auto" prefers CUDA)."""
+    AUTO = "auto"
+    CUDA = "cuda"
+    CPU = "cpu"
+
+
+class LocalQuantization(str, Enum):
+    """Available quantizations of the local model (applied on CPU only)."""
+    NONE = "none"
+    INT8 = "int8"
+
+
+class TileFetchMode(str, Enum):
+    """Available tile download engines."""
+    ASYNC = "async"
+    THREADS = "threads"
+
+
+class AnnotationFormat(str, Enum):
+    """Available encodings of annotated analysis images."""
+    PNG = "png"
+    WEBP = "webp"
+    JPEG = "jpeg"
+
+
+class ReplicateUploadMode(str, Enum):
+    """Available ways of passing images to Replicate."""
+    INLINE = "inline"
+    FILES = "files"
+
+
+class TileFetchPolicy:
+    """
+    Tuning knobs of the tile fetcher: AIMD concurrency control (additive
+    increase while requests succeed fast enough, multiplicative decrease on
+    errors, throttling or slow responses), per-tile retries with jittered
+    exponential backoff, per-host circuit breaking, timeouts and (opt-in)
+    request hedging.
+    """
+
+    def __init__(
+        self,
+        min_concurrency: int = 4,
+        initial_concurrency: int = 16,
+        max_concurrency: int = 64,
+        additive_increase: float = 1.0,
+        multiplicative_decrease: float = 0.5,
+        decrease_interval: float = 1.0,
+        target_latency: float = 2.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.25,
+        backoff_max: float = 8.0,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 30.0,
+        timeout: float = 10.0,
+        hedge_percentile: float | None = None,
+        hedge_min_samples: int = 50,
+    ):
+        assert 0 < min_concurrency <= initial_concurrency <= max_concurrency
+        assert 0 < multiplicative_decrease < 1
+
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        # concurrency gained per window of successful requests, and the share
+        # kept on a failure (at most once per `decrease_interval` seconds)
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.decrease_interval = decrease_interval
+        # responses slower than this (in seconds) count as congestion
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # consecutive failures that open a host's breaker, and for how long
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        # per-request timeout (in seconds), and – if set – the percentile of
+        # recent tile latencies after which a duplicate request is sent to
+        # another host, once there are enough samples to go by
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+
+    def __repr__(self):
+        return f"TileFetchPolicy({self.__dict__})"
+
+    @classmethod
+    def from_env(cls) -> "TileFetchPolicy":
+        return cls(
+            min_concurrency=int(os.getenv("TILE_MIN_CONCURRENCY", "4")),
+            initial_concurrency=int(os.getenv("TILE_INITIAL_CONCURRENCY", "16")),
+            max_concurrency=int(os.getenv("TILE_MAX_CONCURRENCY", "64")),
+            target_latency=float(os.getenv("TILE_TARGET_LATENCY", "2.0")),
+            max_retries=int(os.getenv("TILE_MAX_RETRIES", "3")),
+            backoff_base=float(os.getenv("TILE_BACKOFF_BASE", "0.25")),
+            backoff_max=float(os.getenv("TILE_BACKOFF_MAX", "8.0")),
+            breaker_threshold=int(os.getenv("TILE_BREAKER_THRESHOLD", "5")),
+            breaker_cooldown=float(os.getenv("TILE_BREAKER_COOLDOWN", "30.0")),
+            timeout=float(os.getenv("TILE_TIMEOUT", "10.0")),
+            hedge_percentile=float(os.getenv("TILE_HEDGE_PERCENTILE")) if os.getenv("TILE_HEDGE_PERCENTILE") else None,
+        )
+
+    def retryable(self, status_code: int) -> bool:
+        """
+        Whether a response is worth retrying. A 404 isn't: it's how purged
+        or not (yet) existing imagery is reported.
+        """
+        return status_code == 429 or status_code >= 500
+
+    def backoff(self, attempt: int) -> float:
+        """
+        Seconds to wait before the given retry (starting at 1), using "full
+        jitter", see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        """
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+
 class Config:
     """
     Backend configuration with environment variable support.
@@ -18,22 +138,127 @@ class Config:
         os.getenv("ANALYZER_TYPE", "replicate")
     )
     
+    # Local Analyzer (CPU inference uses dynamic int8 quantization by default,
+    # and thread counts of 0 leave PyTorch's defaults)
+    LOCAL_DEVICE: LocalDevice = LocalDevice(os.getenv("LOCAL_DEVICE", "auto"))
+    LOCAL_QUANTIZATION: LocalQuantization = LocalQuantization(
+        os.getenv("LOCAL_QUANTIZATION", "int8")
+    )
+    LOCAL_INTRA_OP_THREADS: int = int(os.getenv("LOCAL_INTRA_OP_THREADS", "0"))
+    LOCAL_INTER_OP_THREADS: int = int(os.getenv("LOCAL_INTER_OP_THREADS", "0"))
+    # Images (or windows of them) per forward pass, halved on running out of memory
+    LOCAL_BATCH_SIZE: int = int(os.getenv("LOCAL_BATCH_SIZE", "4"))
+    # How long the inference worker waits for concurrent analyses to batch together
+    LOCAL_BATCH_WINDOW_MS: float = float(os.getenv("LOCAL_BATCH_WINDOW_MS", "10"))
+    
     # Replicate Configuration
     REPLICATE_API_TOKEN: str | None = os.getenv("REPLICATE_API_TOKEN")
+    # Override to point the client at a local mock, see benchmarks/mock_replicate.py
+    REPLICATE_BASE_URL: str | None = os.getenv("REPLICATE_BASE_URL") or None
+    # Images analyzed concurrently, and predictions created per second (with
+    # bursts of up to REPLICATE_BURST) – Replicate allows 600 per minute
+    REPLICATE_MAX_CONCURRENCY: int = int(os.getenv("REPLICATE_MAX_CONCURRENCY", "4"))
+    REPLICATE_REQUESTS_PER_SECOND: float = float(os.getenv("REPLICATE_REQUESTS_PER_SECOND", "10"))
+    REPLICATE_BURST: int = int(os.getenv("REPLICATE_BURST", "10"))
+    # Images are sent inline as data URIs, or uploaded once to Replicate's
+    # files API and referenced by URL
+    REPLICATE_UPLOAD_MODE: ReplicateUploadMode = ReplicateUploadMode(
+        os.getenv("REPLICATE_UPLOAD_MODE", "inline")
+    )
     
     # Image Processing
     DEFAULT_BOX_THRESHOLD: float = float(os.getenv("BOX_THRESHOLD", "0.2"))
     DEFAULT_TEXT_THRESHOLD: float = float(os.getenv("TEXT_THRESHOLD", "0.2"))
+    # Detection runs on overlapping windows of large images (0 disables it),
+    # and duplicates at the seams are merged when covering this much of a box
+    ANALYSIS_TILE_SIZE: int = int(os.getenv("ANALYSIS_TILE_SIZE", "1280"))
+    ANALYSIS_TILE_OVERLAP: int = int(os.getenv("ANALYSIS_TILE_OVERLAP", "256"))
+    ANALYSIS_TILE_MERGE_THRESHOLD: float = float(os.getenv("ANALYSIS_TILE_MERGE_THRESHOLD", "0.5"))
     
     # Image Compression for Replicate API
     MAX_IMAGE_DIMENSION: int = int(os.getenv("MAX_IMAGE_DIMENSION", "2048"))
     # JPEG quality (85-95 recommended, higher = better quality but larger payload)
     IMAGE_QUALITY: int = int(os.getenv("IMAGE_QUALITY", "60"))
+    # Encoding of uploads (jpeg or webp), the most bytes one may take (quality
+    # and then resolution are lowered to fit, 0 for no limit), and the memory
+    # for reusing encoded uploads
+    REPLICATE_UPLOAD_FORMAT: AnnotationFormat = AnnotationFormat(
+        os.getenv("REPLICATE_UPLOAD_FORMAT", "jpeg")
+    )
+    REPLICATE_UPLOAD_MAX_BYTES: int = int(os.getenv("REPLICATE_UPLOAD_MAX_KB", "1536")) * 1024
+    REPLICATE_UPLOAD_CACHE_BYTES: int = int(os.getenv("REPLICATE_UPLOAD_CACHE_MB", "64")) * 1024 * 1024
+    
+    # Annotated Analysis Images (lossless PNG, or lossy WebP/JPEG at a quality)
+    ANNOTATION_FORMAT: AnnotationFormat = AnnotationFormat(
+        os.getenv("ANNOTATION_FORMAT", "png")
+    )
+    ANNOTATION_QUALITY: int = int(os.getenv("ANNOTATION_QUALITY", "80"))
+    
+    # Downscaled WebP previews of every image (longer side in pixels)
+    DERIVATIVE_SIZES: list[int] = [int(size) for size in os.getenv("DERIVATIVE_SIZES", "256,512,1024").split(",")]
+    DERIVATIVE_QUALITY: int = int(os.getenv("DERIVATIVE_QUALITY", "75"))
     
     # Storage
     DATA_DIR: str = os.getenv("DATA_DIR", "data")
     PROCESSED_DATA_DIR: str = os.getenv("PROCESSED_DATA_DIR", "processed_data")
     
+    # Tile Cache (set TILE_CACHE_MAX_MB=0 to disable)
+    TILE_CACHE_DIR: str = os.getenv("TILE_CACHE_DIR", os.path.join(DATA_DIR, ".tile_cache"))
+    TILE_CACHE_MAX_BYTES: int = int(os.getenv("TILE_CACHE_MAX_MB", "1024")) * 1024 * 1024
+    
+    # Tile Hosts (override to point tile downloads at a local stand-in server)
+    TILE_HOSTS: list[str] = os.getenv("TILE_HOSTS", "khms0,khms1,khms2,khms3").split(",")
+    TILE_URL_TEMPLATE: str = os.getenv(
+        "TILE_URL_TEMPLATE", "https://{host}.google.com/kh/v={version}?x={x}&y={y}&z={zoom}"
+    )
+    TILE_OBLIQUE_URL_TEMPLATE: str = os.getenv(
+        "TILE_OBLIQUE_URL_TEMPLATE", "https://{host}.googleapis.com/kh?v={version}&deg={angle}&x={x}&y={y}&z={zoom}"
+    )
+    # Initial keep-alive connections per tile host (grown on demand)
+    TILE_POOL_SIZE: int = int(os.getenv("TILE_POOL_SIZE", "8"))
+    
+    # Tile Download Engine ("threads" falls back to per-grid thread pools)
+    TILE_FETCH_MODE: TileFetchMode = TileFetchMode(
+        os.getenv("TILE_FETCH_MODE", "async")
+    )
+    # Adaptive concurrency, retries and circuit breaking for tile requests
+    TILE_FETCH_POLICY: TileFetchPolicy = TileFetchPolicy.from_env()
+    
+    # Version History Scan (probe every Nth version, M versions concurrently)
+    VERSION_SCAN_STRIDE: int = int(os.getenv("VERSION_SCAN_STRIDE", "16"))
+    VERSION_SCAN_BATCH: int = int(os.getenv("VERSION_SCAN_BATCH", "8"))
+    # Perceptual tile hashes let re-encoded but identical imagery match (bits)
+    TILE_PERCEPTUAL_HASH: bool = os.getenv("TILE_PERCEPTUAL_HASH", "false").lower() == "true"
+    TILE_PHASH_MAX_DISTANCE: int = int(os.getenv("TILE_PHASH_MAX_DISTANCE", "0"))
+    VERSION_INDEX_DIR: str = os.getenv("VERSION_INDEX_DIR", os.path.join(DATA_DIR, ".version_index"))
+    
+    # Current Version Discovery (override the URL to use a local stand-in page)
+    MAPS_JS_URL: str = os.getenv("MAPS_JS_URL", "https://maps.googleapis.com/maps/api/js")
+    VERSION_TTL_SECONDS: int = int(os.getenv("VERSION_TTL_SECONDS", "3600"))
+    # How long startup waits for the current versions if none are known yet
+    VERSION_STARTUP_TIMEOUT: float = float(os.getenv("VERSION_STARTUP_TIMEOUT", "5"))
+    VERSION_STATE_PATH: str = os.getenv("VERSION_STATE_PATH", os.path.join(DATA_DIR, ".maps_versions.json"))
+    
+    # Memory budget for decoded images kept around for analyses
+    IMAGE_STORE_MAX_BYTES: int = int(os.getenv("IMAGE_STORE_MAX_MB", "512")) * 1024 * 1024
+    # Index of all downloaded images, read instead of scanning DATA_DIR on startup
+    IMAGE_MANIFEST_PATH: str = os.getenv("IMAGE_MANIFEST_PATH", os.path.join(DATA_DIR, ".manifest.sqlite3"))
+    
+    # Background Download Jobs
+    DOWNLOAD_JOB_WORKERS: int = int(os.getenv("DOWNLOAD_JOB_WORKERS", "2"))
+    DOWNLOAD_JOB_TTL_SECONDS: int = int(os.getenv("DOWNLOAD_JOB_TTL_SECONDS", "3600"))
+    DOWNLOAD_JOB_ABANDON_SECONDS: int = int(os.getenv("DOWNLOAD_JOB_ABANDON_SECONDS", "300"))
+    # Requests for coordinates equal to this many decimals share one download
+    COALESCE_COORDINATE_DECIMALS: int = int(os.getenv("COALESCE_COORDINATE_DECIMALS", "5"))
+    # How long the result of an analysis is reused for identical requests
+    ANALYSIS_RESULT_TTL_SECONDS: int = int(os.getenv("ANALYSIS_RESULT_TTL_SECONDS", "3600"))
+    # How many analysis results are kept for reuse at most
+    ANALYSIS_RESULT_MAX_ENTRIES: int = int(os.getenv("ANALYSIS_RESULT_MAX_ENTRIES", "256"))
+    
+    # Persistent cache of detections by image content (set to 0 to disable)
+    ANALYSIS_CACHE_PATH: str = os.getenv("ANALYSIS_CACHE_PATH", os.path.join(DATA_DIR, ".analysis_cache.sqlite3"))
+    ANALYSIS_CACHE_MAX_ENTRIES: int = int(os.getenv("ANALYSIS_CACHE_MAX_ENTRIES", "100000"))
+    
     @classmethod
     def validate(cls) -> None:
         """
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from config import config
+
+
+class AnalysisCache:
+    """
+    A persistent SQLite cache of detections (count and boxes, plus whatever
+    else an analyzer needs to annotate an image again), keyed by the image's
+    content hash, the normalized prompt, both thresholds and the model
+    version (along with any settings changing the detections, such as
+    tiling). Analyzers consult it before running inference, so analyzing the
+    same imagery again – under any image_id – costs neither an API call nor
+    a forward pass. The least recently used entries beyond `max_entries` are
+    evicted (0 disables the cache), and entries of other versions of a model
+    are dropped by `retain_model`.
+    """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS analyses (
+                    content_hash TEXT NOT NULL,
+                    prompt TEXT NOT NULL,
+                    box_threshold REAL NOT NULL,
+                    text_threshold REAL NOT NULL,
+                    model TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    used_at REAL NOT NULL,
+                    PRIMARY KEY (content_hash, prompt, box_threshold, text_threshold, model)
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS analyses_used_at ON analyses (used_at)")
+
+    def __repr__(self):
+        return f"AnalysisCache({self.path}, max_entries={self.max_entries})"
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    @staticmethod
+    def content_hash(image):
+        """A hash of an image's pixels, so that it doesn't matter how (or where) it's saved."""
+
+        digest = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode("utf-8"))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def normalize_prompt(prompt):
+        """Case, whitespace and the trailing period Grounding DINO queries end with don't matter."""
+
+        return " ".join(prompt.lower().split()).rstrip(".").strip()
+
+    def key(self, image, prompt, box_threshold, text_threshold, model, settings=None):
+        if settings:
+            model = f"{model}#{settings}"
+        return (self.content_hash(image), self.normalize_prompt(prompt), float(box_threshold), float(text_threshold), model)
+
+    def get(self, key):
+        """The cached result (a dict) for a `key`, or `None`."""
+
+        if not self.enabled:
+            return None
+
+        with self._lock, self._connection:
+            row = self._connection.execute("""
+                SELECT result FROM analyses
+                WHERE content_hash = ? AND prompt = ? AND box_threshold = ? AND text_threshold = ? AND model = ?
+            """, key).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._connection.execute("""
+                UPDATE analyses SET used_at = ?
+                WHERE content_hash = ? AND prompt = ? AND box_threshold = ? AND text_threshold = ? AND model = ?
+            """, (time.time(), *key))
+        return json.loads(row[0])
+
+    def put(self, key, result):
+        """Caches a JSON serializable result for a `key`, evicting the least recently used entries if need be."""
+
+        if not self.enabled:
+            return
+
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, json.dumps(result), now, now),
+            )
+
+            excess = self._connection.execute("SELECT COUNT(*) FROM analyses").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._connection.execute("""
+                    DELETE FROM analyses WHERE rowid IN (
+                        SELECT rowid FROM analyses ORDER BY used_at LIMIT ?
+                    )
+                """, (excess,))
+                self.evictions += excess
+
+    def invalidate(self, model=None):
+        """
+        Drops the entries of a model version (with whichever settings), or all
+        of them. Returns how many were dropped.
+        """
+
+        with self._lock, self._connection:
+            if model is None:
+                return self._connection.execute("DELETE FROM analyses").rowcount
+            return self._connection.execute(
+                "DELETE FROM analyses WHERE model = ? OR substr(model, 1, ?) = ?",
+                (model, len(model) + 1, f"{model}#"),
+            ).rowcount
+
+    def retain_model(self, model, family):
+        """
+        Drops the entries of every version of a model family (the prefix its
+        versions share) but `model` (with whichever settings), i.e. the ones
+        that went stale when the model was upgraded. Other families' entries,
+        e.g. another analyzer's, are kept.
+        """
+
+        with self._lock, self._connection:
+            dropped = self._connection.execute(
+                "DELETE FROM analyses WHERE substr(model, 1, ?) = ? AND model != ? AND substr(model, 1, ?) != ?",
+                (len(family), family, model, len(model) + 1, f"{model}#"),
+            ).rowcount
+        if dropped:
+            print(f"Dropped {dropped} cached analyses of other {family} versions than {model}")
+        return dropped
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+            return {
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+analysis_cache = AnalysisCache(config.ANALYSIS_CACHE_PATH, config.ANALYSIS_CACHE_MAX_ENTRIES)
@@ -18,11 +18,25 @@ def create_analyzer() -> "ImageAnalyzerInterface":
     """
     if config.ANALYZER_TYPE == AnalyzerType.REPLICATE:
         from .replicate_analyzer import ReplicateAnalyzer
-        return ReplicateAnalyzer(api_token=config.REPLICATE_API_TOKEN)
+        return ReplicateAnalyzer(
+            api_token=config.REPLICATE_API_TOKEN,
+            base_url=config.REPLICATE_BASE_URL,
+            max_concurrency=config.REPLICATE_MAX_CONCURRENCY,
+            requests_per_second=config.REPLICATE_REQUESTS_PER_SECOND,
+            burst=config.REPLICATE_BURST,
+            upload_mode=config.REPLICATE_UPLOAD_MODE,
+        )
     
     elif config.ANALYZER_TYPE == AnalyzerType.LOCAL:
         from .satellite_analyzer import SatelliteAnalyzer
-        return SatelliteAnalyzer()
+        return SatelliteAnalyzer(
+            device=config.LOCAL_DEVICE,
+            quantization=config.LOCAL_QUANTIZATION,
+            intra_op_threads=config.LOCAL_INTRA_OP_THREADS,
+            inter_op_threads=config.LOCAL_INTER_OP_THREADS,
+            batch_size=config.LOCAL_BATCH_SIZE,
+            batch_window=config.LOCAL_BATCH_WINDOW_MS / 1000,
+        )
     
     else:
         raise ValueError(
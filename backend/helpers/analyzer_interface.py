@@ -1,5 +1,6 @@
 from abc import ABC, abstractmethod
 from typing import List, Dict, Any
+from config import AnnotationFormat
 from PIL import Image
 
 
@@ -9,6 +10,12 @@ class ImageAnalyzerInterface(ABC):
     Implementations can use local models, cloud APIs, etc.
     """
 
+    # Identifies the model (and its weights), e.g. to key cached detections by
+    MODEL_VERSION: str
+    # The prefix every version of the analyzer's model shares, which tells its
+    # cached detections apart from other analyzers'
+    MODEL_FAMILY: str
+
     @abstractmethod
     async def analyze_images(
         self,
@@ -18,6 +25,8 @@ class ImageAnalyzerInterface(ABC):
         image_names: List[str],
         box_threshold: float = 0.2,
         text_threshold: float = 0.2,
+        output_format: AnnotationFormat = AnnotationFormat.PNG,
+        output_quality: int = 80,
     ) -> List[Dict[str, Any]]:
         """
         Analyze images for specific objects.
@@ -29,11 +38,21 @@ class ImageAnalyzerInterface(ABC):
             image_names: Names corresponding to each image
             box_threshold: Confidence threshold for bounding boxes
             text_threshold: Confidence threshold for text matching
+            output_format: Encoding of the annotated images
+            output_quality: Quality of lossy annotated images
 
         Returns:
             List of dicts containing:
                 - count: Number of detected objects
                 - boxes: Bounding box coordinates (if available)
                 - image_path: Path to processed/annotated image
+                - image_bytes: The annotated image as saved (encoded once)
+                - media_type: MIME type of the annotated image
+                or, if an image's analysis failed without failing the others,
+                an "error" (with None for count and boxes)
         """
-        pass 
\ No newline at end of file
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Runtime metrics of the analyzer, if it keeps any."""
+        return {} 
\ No newline at end of file
@@ -0,0 +1,59 @@
+import os
+import re
+from io import BytesIO
+
+from config import AnnotationFormat, config
+from PIL import Image
+
+
+MEDIA_TYPES = {
+    AnnotationFormat.PNG: "image/png",
+    AnnotationFormat.WEBP: "image/webp",
+    AnnotationFormat.JPEG: "image/jpeg",
+}
+
+
+def encode_annotation(image: Image.Image, format: AnnotationFormat, quality: int = 80) -> bytes:
+    """
+    Encodes an annotated image once, in the requested format – lossless PNG,
+    or WebP/JPEG at the given quality, which are a fraction of the size.
+    """
+    if format != AnnotationFormat.PNG and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    buffered = BytesIO()
+    if format == AnnotationFormat.PNG:
+        image.save(buffered, format="PNG")
+    elif format == AnnotationFormat.WEBP:
+        image.save(buffered, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(buffered, format="JPEG", quality=quality, optimize=True)
+    return buffered.getvalue()
+
+
+def annotation_path(image_id: str, image_name: str, analysis_type: str, format: AnnotationFormat) -> str:
+    """
+    Where the annotated image for an analysis is saved. The analysis type is
+    part of the name, so analyses of different types don't overwrite each
+    other's images.
+    """
+    analysis_slug = re.sub(r"[^\w-]+", "_", analysis_type).strip("_") or "analysis"
+    return os.path.join(config.PROCESSED_DATA_DIR, image_id, f"{image_name}.{analysis_slug}.{format.value}")
+
+
+def save_annotation(image: Image.Image, image_id: str, image_name: str, analysis_type: str, format: AnnotationFormat, quality: int = 80) -> dict:
+    """
+    Encodes an annotated image, saves it and returns both the encoded bytes
+    and the file reference, as analyzers include them in their results.
+    """
+    data = encode_annotation(image, format, quality)
+    path = annotation_path(image_id, image_name, analysis_type, format)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+    return {
+        "image_path": path,
+        "image_bytes": data,
+        "media_type": MEDIA_TYPES[format],
+    }
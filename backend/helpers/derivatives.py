@@ -0,0 +1,136 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from config import config
+
+
+class Derivatives:
+    """
+    Downscaled WebP copies of downloaded and annotated images – a small
+    pyramid whose smallest level doubles as the thumbnail – so that previews
+    don't require sending (and decoding) full-size images. They're generated
+    once per image in the background, and saved next to the original in a
+    `.derivatives` directory. A derivative older than its original (e.g. an
+    annotation replaced by a new analysis) counts as missing.
+    """
+
+    DIRECTORY = ".derivatives"
+
+    def __init__(self, sizes, quality, workers=1):
+        self.sizes = sorted(sizes)
+        self.quality = quality
+
+        self._scheduled = set()
+        # path -> modification time of the original when last generated
+        self._done = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="derivatives")
+
+        self.generated = 0
+
+    def __repr__(self):
+        return f"Derivatives({self.sizes}, quality={self.quality})"
+
+    def path(self, path, size):
+        directory, name = os.path.split(path)
+        return os.path.join(directory, self.DIRECTORY, f"{name}.{size}.webp")
+
+    def _fresh(self, path, size):
+        try:
+            return os.path.getmtime(self.path(path, size)) >= os.path.getmtime(path)
+        except FileNotFoundError:
+            return False
+
+    def schedule(self, path, image=None):
+        """
+        Generates the derivatives of an image file in the background, unless
+        that's already done or under way. Passing the image if it's at hand
+        already decoded saves decoding it again.
+        """
+
+        with self._lock:
+            if path in self._scheduled or self._done.get(path) == os.path.getmtime(path):
+                return
+            self._scheduled.add(path)
+        self._executor.submit(self._generate, path, image)
+
+    def _generate(self, path, image):
+        try:
+            self.generate(path, image)
+        except Exception as e:
+            print(f"Couldn't generate derivatives of {path}: {e}")
+        finally:
+            with self._lock:
+                self._scheduled.discard(path)
+
+    def generate(self, path, image=None):
+        """
+        Generates all missing derivatives of an image file, from the largest
+        down to the smallest size, each one scaled from the previous one.
+        Sizes at least as large as the original are skipped.
+        """
+
+        mtime = os.path.getmtime(path)
+        if all(self._fresh(path, size) for size in self.sizes):
+            self._done[path] = mtime
+            return
+
+        if image is None:
+            with Image.open(path) as image:
+                image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+
+        os.makedirs(os.path.join(os.path.dirname(path), self.DIRECTORY), exist_ok=True)
+        for size in reversed(self.sizes):
+            if size >= max(image.size):
+                continue
+            image = image.copy()
+            image.thumbnail((size, size), Image.LANCZOS)
+
+            derivative_path = self.path(path, size)
+            tmp_path = f"{derivative_path}.{threading.get_ident()}.tmp"
+            image.save(tmp_path, format="WEBP", quality=self.quality, method=4)
+            os.replace(tmp_path, derivative_path)
+            self.generated += 1
+
+        self._done[path] = mtime
+
+    def best(self, path, size):
+        """
+        The path of the smallest derivative at least `size` pixels on its
+        longer side, or the original's if there's none, along with whether
+        that's a stand-in for a derivative that's yet to be generated (and
+        now scheduled), i.e. whether the answer will change. It won't if the
+        derivative would be at least as large as the original, which is
+        never generated.
+        """
+
+        for candidate in self.sizes:
+            if candidate >= size and self._fresh(path, candidate):
+                return self.path(path, candidate), False
+
+        target = next((candidate for candidate in self.sizes if candidate >= size), None)
+        if target is None or self._done.get(path) == os.path.getmtime(path):
+            return path, False
+        # only the header is read, not the pixels
+        with Image.open(path) as image:
+            if target >= max(image.size):
+                return path, False
+
+        self.schedule(path)
+        return path, True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sizes": self.sizes,
+                "generated": self.generated,
+                "scheduled": len(self._scheduled),
+            }
+
+
+derivatives = Derivatives(config.DERIVATIVE_SIZES, config.DERIVATIVE_QUALITY)
@@ -0,0 +1,228 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from config import config
+
+from .satellite_downloader import DownloadCancelled, DownloadProgress
+
+
+class DownloadJobState:
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    FINISHED = (DONE, FAILED, CANCELLED)
+
+
+class DownloadJob:
+    """
+    A download running in the background. Its `progress` is updated by the
+    downloader as it goes, and doubles as the means of cancelling it. Each
+    version's image is recorded (by path) as soon as it's saved, so that
+    clients attaching late still get all of them. Identical requests share one job,
+    which is only cancelled once every one of its `subscribers` has cancelled.
+    """
+
+    def __init__(self, params, key=None):
+        self.id = str(uuid.uuid4())
+        self.key = key
+        self.params = params
+        self.state = DownloadJobState.PENDING
+        self.progress = DownloadProgress()
+        self.images = []
+        self.result = None
+        self.error = None
+        self.subscribers = 1
+
+        self.created_at = time.time()
+        self.finished_at = None
+        self.last_polled = time.monotonic()
+        self._changed = threading.Condition()
+
+    def __repr__(self):
+        return f"DownloadJob({self.id}, {self.state})"
+
+    def finished(self):
+        return self.state in DownloadJobState.FINISHED
+
+    def touch(self):
+        self.last_polled = time.monotonic()
+
+    def add_image(self, image_id, image, metadata):
+        # only where the image is saved is kept, the job may be around for a
+        # while, and it's read from there once it's streamed
+        with self._changed:
+            self.images.append((image_id, image.path, metadata))
+            self._changed.notify_all()
+
+    def finish(self, state):
+        with self._changed:
+            self.state = state
+            self.finished_at = time.time()
+            self._changed.notify_all()
+
+    def wait(self, timeout=None):
+        """Blocks until the job has finished, returning whether it has."""
+
+        with self._changed:
+            return self._changed.wait_for(self.finished, timeout)
+
+    def wait_for_images(self, seen, timeout=None):
+        """
+        Blocks until there are more than `seen` images or the job has finished,
+        returning the new images (as image_id, path and metadata) and whether
+        the job has finished.
+        """
+
+        with self._changed:
+            self._changed.wait_for(lambda: len(self.images) > seen or self.finished(), timeout)
+            return self.images[seen:], self.finished()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "state": self.state,
+            "params": self.params,
+            "progress": self.progress.to_dict(),
+            "error": self.error,
+            "subscribers": self.subscribers,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class DownloadJobManager:
+    """
+    Runs downloads on a small thread pool instead of in request handlers, so
+    clients submit a job, poll its status and fetch the result once it's done.
+    Jobs submitted with the same key while one is running (or done, within
+    `ttl` seconds) are coalesced into it. Finished jobs are forgotten after
+    `ttl` seconds, and jobs no one has polled for `abandon_after` seconds are
+    cancelled so they stop using bandwidth.
+    """
+
+    def __init__(self, max_workers, ttl, abandon_after):
+        self.ttl = ttl
+        self.abandon_after = abandon_after
+
+        self._jobs = {}
+        self._by_key = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download-job")
+
+        self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+        self._reaper.start()
+
+    def __repr__(self):
+        return f"DownloadJobManager({len(self._jobs)} jobs)"
+
+    def submit(self, fn, params, key=None):
+        """
+        Starts a job running `fn(progress=..., on_image=...)` with the job's
+        progress and image collector and returns it right away – unless a job
+        with the same `key` is running or has succeeded, which is returned
+        instead.
+        """
+
+        with self._lock:
+            job = self._jobs.get(self._by_key.get(key))
+            if job is not None and job.state not in (DownloadJobState.FAILED, DownloadJobState.CANCELLED) \
+                    and not job.progress.cancelled.is_set():
+                job.subscribers += 1
+                job.touch()
+                return job
+
+            job = DownloadJob(params, key)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._by_key[key] = job.id
+        self._executor.submit(self._run, job, fn)
+        return job
+
+    def _run(self, job, fn):
+        if job.progress.cancelled.is_set():
+            job.finish(DownloadJobState.CANCELLED)
+            return
+
+        job.state = DownloadJobState.RUNNING
+        try:
+            job.result = fn(progress=job.progress, on_image=job.add_image)
+            job.finish(DownloadJobState.DONE)
+        except DownloadCancelled:
+            job.finish(DownloadJobState.CANCELLED)
+        except Exception as e:
+            print(f"Download job {job.id} failed: {e}")
+            job.error = str(e)
+            job.finish(DownloadJobState.FAILED)
+
+    def get(self, job_id):
+        """Returns a job, or `None` if it's unknown, counting as a poll."""
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            job.touch()
+        return job
+
+    def cancel(self, job_id):
+        """
+        Requests cancellation of a job on behalf of one of its subscribers.
+        Once all of them have, it takes effect within a fraction of a second
+        (or as soon as the job would have started). Returns the job, or `None`
+        if it's unknown.
+        """
+
+        job = self.get(job_id)
+        if job is None or job.finished():
+            return job
+
+        with self._lock:
+            job.subscribers -= 1
+            if job.subscribers <= 0:
+                job.progress.cancel()
+        return job
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(10, self.abandon_after, self.ttl))
+            self.reap()
+
+    def reap(self):
+        """Cancels abandoned jobs and drops expired ones."""
+
+        now = time.monotonic()
+        with self._lock:
+            jobs = list(self._jobs.values())
+
+        for job in jobs:
+            if job.finished():
+                if time.time() - job.finished_at > self.ttl:
+                    with self._lock:
+                        self._jobs.pop(job.id, None)
+                        if self._by_key.get(job.key) == job.id:
+                            del self._by_key[job.key]
+            elif now - job.last_polled > self.abandon_after:
+                print(f"Download job {job.id} hasn't been polled for {self.abandon_after}s, cancelling...")
+                job.progress.cancel()
+
+    def stats(self):
+        with self._lock:
+            states = [job.state for job in self._jobs.values()]
+        return {state: states.count(state) for state in (
+            DownloadJobState.PENDING,
+            DownloadJobState.RUNNING,
+            DownloadJobState.DONE,
+            DownloadJobState.FAILED,
+            DownloadJobState.CANCELLED,
+        )}
+
+
+download_jobs = DownloadJobManager(
+    max_workers=config.DOWNLOAD_JOB_WORKERS,
+    ttl=config.DOWNLOAD_JOB_TTL_SECONDS,
+    abandon_after=config.DOWNLOAD_JOB_ABANDON_SECONDS,
+)
@@ -0,0 +1,179 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+class AdaptiveLimiter:
+    """
+    An async concurrency limiter whose limit is tuned AIMD-style, like TCP
+    congestion control: every successful, fast-enough request raises it by
+    `additive_increase / limit` (i.e. by `additive_increase` per window of
+    `limit` requests), while errors, throttling and slow responses cut it by
+    `multiplicative_decrease` – at most once per `decrease_interval`, since a
+    burst of failures usually has a single cause. Must be used from a single
+    event loop, on which it has to be created.
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.limit = float(policy.initial_concurrency)
+        self.in_flight = 0
+
+        self.successes = 0
+        self.failures = 0
+        self._last_decrease = 0
+        self._condition = asyncio.Condition()
+
+    def __repr__(self):
+        return f"AdaptiveLimiter({self.in_flight}/{self.limit:.1f})"
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify(max(1, int(self.limit) - self.in_flight))
+
+    def record(self, ok, latency):
+        """Adjusts the limit according to the outcome of a request."""
+
+        if ok and latency <= self.policy.target_latency:
+            self.successes += 1
+            self.limit = min(self.policy.max_concurrency, self.limit + self.policy.additive_increase / self.limit)
+            return
+
+        self.failures += 1
+        now = time.monotonic()
+        if now - self._last_decrease >= self.policy.decrease_interval:
+            self._last_decrease = now
+            self.limit = max(self.policy.min_concurrency, self.limit * self.policy.multiplicative_decrease)
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 1),
+            "in_flight": self.in_flight,
+            "successes": self.successes,
+            "failures": self.failures,
+        }
+
+
+class TokenBucket:
+    """
+    An async token bucket rate limiter: tokens are added at `rate` per second
+    up to `burst`, and every request takes one – waiting for it, in order of
+    arrival, when there's none left. A `rate` of 0 disables it. Must be used
+    from a single event loop.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+
+        self.acquired = 0
+        self.waited = 0.0
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def __repr__(self):
+        return f"TokenBucket({self.tokens:.1f}/{self.burst} at {self.rate}/s)"
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+
+        # waiting while holding the lock keeps waiters in order
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.acquired += 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+                self.waited += wait
+                await asyncio.sleep(wait)
+
+    def stats(self):
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "acquired": self.acquired,
+            "waited_seconds": round(self.waited, 1),
+        }
+
+
+class CircuitBreaker:
+    """
+    A per-host circuit breaker: after `threshold` consecutive failures, the
+    host is taken out of rotation ("open") for `cooldown` seconds. After that,
+    it's let back in ("half-open") – one more failure opens it again right
+    away, while a success closes it. Thread-safe.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"CircuitBreaker({self.state()})"
+
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def allows(self):
+        return self.state() != "open"
+
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                self.consecutive_failures = 0
+                self.opened_at = None
+                return
+
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class LatencyTracker:
+    """Keeps the latencies of the most recent requests to derive percentiles."""
+
+    def __init__(self, window=512):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"LatencyTracker({len(self._latencies)} samples)"
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def record(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, p):
+        """The `p`th percentile (0-100) of the recorded latencies."""
+
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
@@ -0,0 +1,140 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from PIL import Image
+
+from config import config
+
+
+# matches the file names SatelliteDownloader saves images under, see its
+# `image_path_template`
+IMAGE_NAME_PATTERN = re.compile(r"-v(?P<version>\d+)-.*-z\d+-(?P<latitude>-?[\d.]+),(?P<longitude>-?[\d.]+)-(?P<zoom>\d+)x\d+m\.\w+$")
+
+
+class ImageManifest:
+    """
+    A persistent SQLite index of the downloaded images: for every image_id,
+    its files along with their dimensions, imagery version and the requested
+    coordinates and zoom. It's updated in one transaction per finished
+    download, so startup only needs to read it instead of walking the data
+    directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    image_id TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    version INTEGER,
+                    width INTEGER,
+                    height INTEGER,
+                    latitude REAL,
+                    longitude REAL,
+                    zoom INTEGER,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (image_id, name)
+                )
+            """)
+
+    def __repr__(self):
+        return f"ImageManifest({self.path})"
+
+    def empty(self):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM images LIMIT 1").fetchone() is None
+
+    def record(self, image_id, entries):
+        """
+        Replaces the entries of an image_id, each a dict with the file's
+        `name` and (optionally) `version`, `width`, `height`, `latitude`,
+        `longitude` and `zoom`, atomically.
+        """
+
+        self.record_many({image_id: entries})
+
+    def record_many(self, entries_by_id):
+        """Like `record`, for many image_ids in a single transaction."""
+
+        now = time.time()
+        rows = [(
+            image_id,
+            entry["name"],
+            entry.get("version"),
+            entry.get("width"),
+            entry.get("height"),
+            entry.get("latitude"),
+            entry.get("longitude"),
+            entry.get("zoom"),
+            now,
+        ) for image_id, entries in entries_by_id.items() for entry in entries]
+
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM images WHERE image_id = ?", [(image_id,) for image_id in entries_by_id])
+            self._connection.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def remove(self, image_id):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM images WHERE image_id = ?", (image_id,))
+
+    @staticmethod
+    def order(entry):
+        """Sort key of entries: oldest imagery version first, unknown versions last."""
+
+        return (entry.get("version") is None, entry.get("version") or 0, entry["name"])
+
+    def files(self):
+        """Returns the file names of every image_id, in the order of `order`."""
+
+        files = {}
+        with self._lock:
+            for image_id, name in self._connection.execute(
+                "SELECT image_id, name FROM images ORDER BY image_id, version IS NULL, version, name"
+            ):
+                files.setdefault(image_id, []).append(name)
+        return files
+
+    def entries(self, image_id):
+        with self._lock:
+            cursor = self._connection.execute("SELECT * FROM images WHERE image_id = ? ORDER BY name", (image_id,))
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor]
+
+    @staticmethod
+    def describe(path):
+        """
+        Derives an entry for an image file saved before the manifest existed,
+        from its name and header (without decoding it).
+        """
+
+        name = os.path.basename(path)
+        entry = {"name": name}
+
+        match = IMAGE_NAME_PATTERN.search(name)
+        if match:
+            entry.update(
+                version=int(match["version"]),
+                latitude=float(match["latitude"]),
+                longitude=float(match["longitude"]),
+                zoom=int(match["zoom"]),
+            )
+
+        try:
+            with Image.open(path) as image:
+                entry.update(width=image.width, height=image.height)
+        except Exception:
+            pass
+
+        return entry
+
+
+image_manifest = ImageManifest(config.IMAGE_MANIFEST_PATH)
@@ -0,0 +1,170 @@
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from config import config
+
+from .image_manifest import ImageManifest, image_manifest
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class ImageStore:
+    """
+    An index of the downloaded images under the data directory, by image_id,
+    that only decodes them on demand. Decoded images are kept in an LRU
+    bounded by their size in memory (width x height x bands), and files are
+    closed right after decoding, so neither memory nor file descriptors grow
+    with the number of downloads. The index itself is loaded from the image
+    manifest, which is only built from the directory's contents once.
+    """
+
+    def __init__(self, directory, max_bytes, manifest):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.manifest = manifest
+
+        # image_id -> file names, oldest version first (see `ImageManifest.order`)
+        self._index = {}
+        # file path -> decoded image, ordered from least to most recently used
+        self._decoded = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        if manifest.empty():
+            self._migrate()
+        self._index = manifest.files()
+
+    def __repr__(self):
+        return f"ImageStore({self.directory}, {len(self._index)} ids, {self._size}/{self.max_bytes} bytes)"
+
+    def __contains__(self, image_id):
+        return image_id in self._index
+
+    def _migrate(self):
+        """Records images downloaded before the manifest existed in it."""
+
+        # dot-directories hold internal state such as the tile cache
+        image_ids = [f.name for f in os.scandir(self.directory) if f.is_dir() and not f.name.startswith(".")]
+        if image_ids:
+            print(f"Building the image manifest from {len(image_ids)} image directories...")
+        self.manifest.record_many({
+            image_id: [ImageManifest.describe(self._path(image_id, name)) for name in self._list(image_id)]
+            for image_id in image_ids
+        })
+
+    def _list(self, image_id):
+        image_dir = os.path.join(self.directory, image_id)
+        return sorted(f.name for f in os.scandir(image_dir) if f.name.endswith(IMAGE_EXTENSIONS))
+
+    def _path(self, image_id, name):
+        return os.path.join(self.directory, image_id, name)
+
+    def path(self, image_id, name):
+        """The path of an indexed image file, or `None` if it's unknown."""
+
+        if name not in (self.names(image_id) or ()):
+            return None
+        return self._path(image_id, name)
+
+    def entries(self, image_id):
+        """
+        The manifest entries of an image_id's images (see `ImageManifest`),
+        oldest version first, each with its `path`.
+        """
+
+        entries = self.manifest.entries(image_id)
+        for entry in entries:
+            entry["path"] = self._path(image_id, entry["name"])
+        return sorted(entries, key=ImageManifest.order)
+
+    @staticmethod
+    def _nbytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def ids(self):
+        return list(self._index)
+
+    def names(self, image_id):
+        """The file names of an image_id's images, or `None` if it's unknown."""
+
+        return self._index.get(image_id)
+
+    def add(self, image_id, entries, images=None):
+        """
+        Records the images just saved for an image_id in the manifest (see
+        `ImageManifest.record` for the entries) and indexes them. If they're
+        at hand already decoded (by file name), they're kept as well, which
+        saves decoding them again for a subsequent analysis.
+        """
+
+        self.manifest.record(image_id, entries)
+        self._index[image_id] = [entry["name"] for entry in sorted(entries, key=ImageManifest.order)]
+        for name, image in (images or {}).items():
+            self._keep(self._path(image_id, name), image)
+
+    def images(self, image_id):
+        """
+        Returns the decoded images of an image_id (in the order of `names`),
+        or `None` if it's unknown.
+        """
+
+        names = self.names(image_id)
+        if names is None:
+            return None
+        return [self._load(self._path(image_id, name)) for name in names]
+
+    def _load(self, path):
+        with self._lock:
+            image = self._decoded.get(path)
+            if image is not None:
+                self._decoded.move_to_end(path)
+                self.hits += 1
+                return image
+            self.misses += 1
+
+        # decode right away, so the file is closed when leaving the block
+        with Image.open(path) as image:
+            image.load()
+        self._keep(path, image)
+        return image
+
+    def _keep(self, path, image):
+        nbytes = self._nbytes(image)
+        if nbytes > self.max_bytes:
+            return
+
+        with self._lock:
+            if path in self._decoded:
+                self._size -= self._nbytes(self._decoded.pop(path))
+            self._decoded[path] = image
+            self._size += nbytes
+
+            # drop least recently used images until the budget is met again
+            while self._size > self.max_bytes:
+                _, evicted = self._decoded.popitem(last=False)
+                self._size -= self._nbytes(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "image_ids": len(self._index),
+                "decoded": len(self._decoded),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+image_store = ImageStore(config.DATA_DIR, config.IMAGE_STORE_MAX_BYTES, image_manifest)
@@ -0,0 +1,180 @@
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+
+
+class InferenceRequest:
+    """Images submitted for inference, and the future their results are delivered to."""
+
+    def __init__(self, images, key, loop):
+        self.images = images
+        self.key = key
+        self.loop = loop
+        self.future = loop.create_future()
+        self.submitted_at = time.monotonic()
+
+    def resolve(self, results=None, error=None):
+        try:
+            self.loop.call_soon_threadsafe(self._resolve, results, error)
+        except RuntimeError:
+            pass  # the caller's event loop is closed, so no one's waiting anymore
+
+    def _resolve(self, results, error):
+        # the caller may have gone away (e.g. its request was cancelled)
+        if self.future.done():
+            return
+        if error is not None:
+            self.future.set_exception(error)
+        else:
+            self.future.set_result(results)
+
+
+class InferenceWorker:
+    """
+    Runs blocking inference on a dedicated thread, so the event loop stays
+    free while a model is busy. Concurrent callers `submit` images and await
+    a future; the worker takes the oldest request off the queue and, for up
+    to `window` seconds (or until `max_images` images are collected), adds
+    other requests for the same key (e.g. prompt and thresholds) to it, then
+    runs them as one micro-batch with `run(images, *key)`, which returns one
+    result per image. If a micro-batch of several requests fails, they're
+    retried one by one so that only the culprit fails.
+    """
+
+    def __init__(self, run, max_images, window, name="inference"):
+        self.run = run
+        self.max_images = max(1, max_images)
+        self.window = window
+
+        self._queue = queue.Queue()
+        # requests taken off the queue while collecting another key's batch
+        self._deferred = deque()
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.batches = 0
+        self.images = 0
+        self.failures = 0
+        self.max_batch_size = 0
+        self.wait_seconds = 0.0
+        self.busy_seconds = 0.0
+
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f"InferenceWorker({self.queue_depth} queued, max_images={self.max_images}, window={self.window}s)"
+
+    @property
+    def queue_depth(self):
+        """Requests waiting to be batched (the worker thread's `_deferred` is read without its lock, as a snapshot)."""
+
+        return self._queue.qsize() + len(self._deferred)
+
+    async def submit(self, images, key=()):
+        """Returns the results of running `images` (one per image), from the worker thread."""
+
+        request = InferenceRequest(images, key, asyncio.get_running_loop())
+        self._queue.put(request)
+        return await request.future
+
+    def _next(self, timeout=None):
+        if self._deferred:
+            return self._deferred.popleft()
+        return self._queue.get(timeout=timeout)
+
+    def _collect(self, batch):
+        """
+        Adds the oldest request to an empty `batch`, along with those for the
+        same key arriving within the window.
+        """
+
+        batch.append(self._next())
+        size = len(batch[0].images)
+        deadline = time.monotonic() + self.window
+
+        # deferred requests are older than any on the queue
+        for request in list(self._deferred):
+            if size >= self.max_images:
+                break
+            if request.key == batch[0].key:
+                self._deferred.remove(request)
+                batch.append(request)
+                size += len(request.images)
+
+        while size < self.max_images:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request.key != batch[0].key:
+                self._deferred.append(request)
+                continue
+            batch.append(request)
+            size += len(request.images)
+
+    def _loop(self):
+        while True:
+            batch = []
+            try:
+                self._step(batch)
+            except Exception as e:
+                # fail the requests at hand rather than the worker, lest all
+                # later ones wait forever
+                print(f"⚠️  Inference worker failed on a batch of {len(batch)} requests: {e}")
+                with self._lock:
+                    self.failures += len(batch)
+                for request in batch:
+                    request.resolve(error=e)
+
+    def _step(self, batch):
+        self._collect(batch)
+        started = time.monotonic()
+        self._run(batch)
+
+        with self._lock:
+            self.requests += len(batch)
+            self.batches += 1
+            size = sum(len(request.images) for request in batch)
+            self.images += size
+            self.max_batch_size = max(self.max_batch_size, size)
+            self.wait_seconds += sum(started - request.submitted_at for request in batch)
+            self.busy_seconds += time.monotonic() - started
+
+    def _run(self, batch):
+        images = [image for request in batch for image in request.images]
+        try:
+            results = self.run(images, *batch[0].key)
+        except Exception as e:
+            if len(batch) == 1:
+                with self._lock:
+                    self.failures += 1
+                batch[0].resolve(error=e)
+                return
+            for request in batch:
+                self._run([request])
+            return
+
+        start = 0
+        for request in batch:
+            request.resolve(results[start:start + len(request.images)])
+            start += len(request.images)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "requests": self.requests,
+                "batches": self.batches,
+                "images": self.images,
+                "failures": self.failures,
+                "mean_batch_size": round(self.images / self.batches, 2) if self.batches else None,
+                "max_batch_size": self.max_batch_size,
+                "mean_wait_ms": round(1000 * self.wait_seconds / self.requests, 1) if self.requests else None,
+                "busy_seconds": round(self.busy_seconds, 1),
+            }
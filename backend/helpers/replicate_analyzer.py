@@ -1,31 +1,76 @@
-import base64
+import asyncio
 import os
+import random
+import time
+from datetime import datetime
 from io import BytesIO
 from typing import Any, Dict, List
 
 import replicate
-from config import config
+from config import AnnotationFormat, ReplicateUploadMode
 from PIL import Image, ImageDraw, ImageFont
+from replicate.exceptions import ReplicateError
 
+from .analysis_cache import analysis_cache
 from .analyzer_interface import ImageAnalyzerInterface
+from .annotation_encoding import save_annotation
+from .fetch_control import TokenBucket
+from .tiled_inference import tiler
+from .upload_encoder import EncodedUpload, upload_encoder
 
 
 class ReplicateAnalyzer(ImageAnalyzerInterface):
     """
     Image analyzer using Replicate's hosted Grounding DINO model.
     No local GPU/CUDA required - all inference happens via API.
+    Images are analyzed concurrently, with predictions rate limited, and
+    large ones in overlapping windows, see `Tiler`.
     """
 
     MODEL_VERSION = "adirik/grounding-dino:efd10a8ddc57ea28773327e881ce95e20cc1d734c589f7dd01d2036921ed78aa"
+    MODEL_FAMILY = "adirik/grounding-dino:"
 
-    def __init__(self, api_token: str | None = None):
+    # Retries of predictions rejected with 429 Too Many Requests (the client
+    # only retries idempotent requests itself)
+    MAX_RETRIES = 3
+    BACKOFF_BASE = 1.0
+
+    # How long an image uploaded to the files API is referenced at most
+    FILE_REUSE_SECONDS = 3600
+
+    def __init__(
+        self,
+        api_token: str | None = None,
+        base_url: str | None = None,
+        max_concurrency: int = 4,
+        requests_per_second: float = 10.0,
+        burst: int = 10,
+        upload_mode: ReplicateUploadMode = ReplicateUploadMode.INLINE,
+    ):
         """
         Initialize Replicate client.
 
         Args:
             api_token: Replicate API token (defaults to REPLICATE_API_TOKEN env var)
+            base_url: Replicate API URL (defaults to Replicate's own)
+            max_concurrency: Predictions in flight at once
+            requests_per_second: Predictions created per second (0 for no limit)
+            burst: Predictions created at once before the rate limit applies
+            upload_mode: Whether to send images inline, or upload them to the files API
         """
-        self.client = replicate.Client(api_token=api_token or os.getenv("REPLICATE_API_TOKEN"))
+        self.client = replicate.Client(api_token=api_token or os.getenv("REPLICATE_API_TOKEN"), base_url=base_url)
+        self.concurrency = asyncio.Semaphore(max_concurrency)
+        self.rate_limiter = TokenBucket(requests_per_second, burst)
+
+        self.upload_mode = upload_mode
+        # content hash -> URL of the uploaded image, and until when to use it
+        self._file_urls = {}
+
+    @property
+    def settings(self):
+        """What changes the detections besides the model, e.g. to key cached ones by."""
+
+        return ",".join(setting for setting in (tiler.signature, upload_encoder.signature) if setting) or None
 
     async def analyze_images(
         self,
@@ -35,24 +80,39 @@ class ReplicateAnalyzer(ImageAnalyzerInterface):
         image_names: List[str],
         box_threshold: float = 0.2,
         text_threshold: float = 0.2,
+        output_format: AnnotationFormat = AnnotationFormat.PNG,
+        output_quality: int = 80,
     ) -> List[Dict[str, Any]]:
         """
-        Analyze images using Replicate's Grounding DINO API.
+        Analyze images using Replicate's Grounding DINO API, all at once (up
+        to the concurrency and rate limits). An image whose analysis fails
+        gets a result with an "error" (and no count) rather than failing the
+        others.
         """
-        results = []
-
-        for image, image_name in zip(images, image_names):
-            result = await self._analyze_single_image(
+        return await asyncio.gather(*[
+            self._analyze_single_image_isolated(
                 image=image,
                 analysis_type=analysis_type,
                 image_id=image_id,
                 image_name=image_name,
                 box_threshold=box_threshold,
                 text_threshold=text_threshold,
+                output_format=output_format,
+                output_quality=output_quality,
             )
-            results.append(result)
+            for image, image_name in zip(images, image_names)
+        ])
 
-        return results
+    async def _analyze_single_image_isolated(self, image_name: str, **kwargs) -> Dict[str, Any]:
+        try:
+            return await self._analyze_single_image(image_name=image_name, **kwargs)
+        except Exception as e:
+            print(f"❌ Analysis of {image_name} failed: {e}")
+            return {
+                "count": None,
+                "boxes": None,
+                "error": str(e),
+            }
 
     async def _analyze_single_image(
         self,
@@ -62,6 +122,8 @@ class ReplicateAnalyzer(ImageAnalyzerInterface):
         image_name: str,
         box_threshold: float,
         text_threshold: float,
+        output_format: AnnotationFormat = AnnotationFormat.PNG,
+        output_quality: int = 80,
     ) -> Dict[str, Any]:
         """
         Analyze a single image via Replicate API.
@@ -70,34 +132,115 @@ class ReplicateAnalyzer(ImageAnalyzerInterface):
         if hasattr(image, 'image'):
             image = image.image
         
-        # Store original image size for coordinate conversion
-        original_size = image.size
-            
-        image_data_uri = self._image_to_data_uri(image)
+        # The same imagery analyzed the same way before needn't be uploaded again
+        # (hashing the pixels and SQLite take a moment, so keep them off the event loop)
+        cache_key = await asyncio.to_thread(
+            analysis_cache.key, image, analysis_type, box_threshold, text_threshold, self.MODEL_VERSION, self.settings
+        )
+        cached = await asyncio.to_thread(analysis_cache.get, cache_key)
+        if cached is not None:
+            print(f"♻️  Using cached detections for {image_name}")
+            count, boxes = cached["count"], cached["boxes"]
+        else:
+            count, boxes = await self._detect_tiled(image, analysis_type, box_threshold, text_threshold)
+            await asyncio.to_thread(analysis_cache.put, cache_key, {"count": count, "boxes": boxes})
 
-        query = f"{analysis_type}."
+        # Always draw boxes manually since we have more control
+        # and can ensure they're visible
+        # The annotated image is encoded once, and returned as well as saved
+        if boxes:
+            print(f"✏️  Drawing {len(boxes)} bounding boxes on image")
+            annotated_image = self._draw_boxes_on_image(image.copy(), boxes)
+        else:
+            print(f"⚠️  No boxes to draw, saving original image")
+            annotated_image = image
+        annotation = save_annotation(annotated_image, image_id, image_name, analysis_type, output_format, output_quality)
+        print(f"💾 Saved {'annotated' if boxes else 'original'} image to: {annotation['image_path']} ({len(annotation['image_bytes']) / 1024:.0f}KB)")
 
-        try:
-            output = await self.client.async_run(
-                self.MODEL_VERSION,
-                input={
-                    "image": image_data_uri,
-                    "query": query,
-                    "box_threshold": box_threshold,
-                    "text_threshold": text_threshold,
-                    "show_visualisation": True,
-                },
-            )
-            print(f"🔍 Replicate API Response Type: {type(output)}")
-            print(f"🔍 Replicate API Response: {output}")
-        except Exception as e:
-            print(f"❌ Replicate API error: {e}")
-            raise
+        return {
+            "count": count,
+            "boxes": boxes,
+            **annotation,
+        }
+
+    async def _detect_tiled(
+        self,
+        image: Image.Image,
+        analysis_type: str,
+        box_threshold: float,
+        text_threshold: float,
+    ) -> tuple[int, List[List[float]]]:
+        """
+        Run Grounding DINO on each window of an image concurrently, returning
+        the count and the boxes (in pixels) of the detections, merged across
+        windows.
+        """
+        crops = await asyncio.to_thread(tiler.crops, image)
+        if len(crops) > 1:
+            print(f"🧩 Analyzing {image.width}x{image.height} image in {len(crops)} windows")
 
-        count = self._extract_count(output)
-        boxes = self._extract_boxes(output, original_size)
+        detections = await asyncio.gather(*[
+            self._detect(crop, analysis_type, box_threshold, text_threshold)
+            for _, crop in crops
+        ])
+        boxes, _, _ = tiler.merge(
+            [window for window, _ in crops],
+            [window_boxes for window_boxes, _ in detections],
+            [window_scores for _, window_scores in detections],
+        )
+        return len(boxes), boxes
 
-        os.makedirs(f"processed_data/{image_id}", exist_ok=True)
+    async def _detect(
+        self,
+        image: Image.Image,
+        analysis_type: str,
+        box_threshold: float,
+        text_threshold: float,
+    ) -> tuple[List[List[float]], List[float]]:
+        """
+        Run Grounding DINO on an image via Replicate API, returning the boxes
+        (in pixels) of the detections and their confidence.
+        """
+        image_input, upload = await self._image_input(image)
+
+        query = f"{analysis_type}."
+
+        attempt = 0
+        while True:
+            try:
+                async with self.concurrency:
+                    await self.rate_limiter.acquire()
+                    output = await self.client.async_run(
+                        self.MODEL_VERSION,
+                        input={
+                            "image": image_input,
+                            "query": query,
+                            "box_threshold": box_threshold,
+                            "text_threshold": text_threshold,
+                            "show_visualisation": True,
+                        },
+                    )
+                print(f"🔍 Replicate API Response Type: {type(output)}")
+                print(f"🔍 Replicate API Response: {output}")
+                break
+            except ReplicateError as e:
+                attempt += 1
+                if e.status != 429 or attempt > self.MAX_RETRIES:
+                    print(f"❌ Replicate API error: {e}")
+                    raise
+                # full jitter, like the tile fetcher's backoff
+                backoff = random.uniform(0, self.BACKOFF_BASE * 2 ** (attempt - 1))
+                print(f"⏳ Replicate API rate limited, retrying in {backoff:.1f}s")
+                await asyncio.sleep(backoff)
+            except Exception as e:
+                print(f"❌ Replicate API error: {e}")
+                raise
+
+        # boxes come in the coordinates of the image as uploaded, which may
+        # have been downscaled
+        boxes, scores = self._extract_detections(output, upload.size)
+        scale_x, scale_y = image.width / upload.size[0], image.height / upload.size[1]
+        boxes = [[x1 * scale_x, y1 * scale_y, x2 * scale_x, y2 * scale_y] for x1, y1, x2, y2 in boxes]
 
         # Handle Replicate output format
         visualization_url = None
@@ -109,70 +252,49 @@ class ReplicateAnalyzer(ImageAnalyzerInterface):
         
         print(f"🖼️  Visualization URL: {visualization_url}")
 
-        # Always draw boxes manually since we have more control
-        # and can ensure they're visible
-        if boxes:
-            print(f"✏️  Drawing {len(boxes)} bounding boxes on image")
-            annotated_image = self._draw_boxes_on_image(image.copy(), boxes)
-            output_path = f"processed_data/{image_id}/{image_name}.png"
-            annotated_image.save(output_path)
-            print(f"💾 Saved annotated image to: {output_path}")
-        else:
-            print(f"⚠️  No boxes to draw, saving original image")
-            output_path = f"processed_data/{image_id}/{image_name}.png"
-            image.save(output_path)
-            print(f"💾 Saved original image to: {output_path}")
-
-        return {
-            "count": count,
-            "boxes": boxes,
-            "image_path": output_path,
-        }
+        return boxes, scores
 
-    def _image_to_data_uri(self, image: Image.Image) -> str:
+    async def _image_input(self, image: Image.Image) -> tuple[str, EncodedUpload]:
         """
-        Convert PIL Image to data URI for Replicate API.
-        Handles MapTileImage wrappers and RGBA conversion.
+        Encode an image for Replicate API (see `UploadEncoder`), returning the
+        input to pass – a data URI, or the URL of the image uploaded once to
+        the files API – along with the encoded image.
         """
         # Extract PIL image if wrapped
         if hasattr(image, 'image'):
             image = image.image
-        
-        # Convert RGBA to RGB if needed (JPEG doesn't support transparency)
-        if image.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', image.size, (255, 255, 255))
-            if image.mode == 'P':
-                image = image.convert('RGBA')
-            background.paste(image, mask=image.split()[-1] if image.mode in ('RGBA', 'LA') else None)
-            image = background
-        elif image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        buffered = BytesIO()
-        image.save(buffered, format="JPEG", quality=config.IMAGE_QUALITY, optimize=True)
-        img_bytes = buffered.getvalue()
-        img_base64 = base64.b64encode(img_bytes).decode()
-        base64_size = len(img_base64)
-        print(f"📤 Upload size: {base64_size / 1024 / 1024:.2f}MB (base64)")
-        
-        return f"data:image/jpeg;base64,{img_base64}"
 
-    def _extract_count(self, output: Dict[str, Any]) -> int:
-        """
-        Extract detection count from Replicate output.
-        """
-        if isinstance(output, dict):
-            detections = output.get("detections", [])
-            return len(detections) if detections else 0
-        return 0
+        upload = await asyncio.to_thread(upload_encoder.encode, image)
+        print(f"📤 Upload size: {len(upload.data) / 1024 / 1024:.2f}MB ({upload.size[0]}x{upload.size[1]} {upload.media_type})")
+        if self.upload_mode == ReplicateUploadMode.INLINE:
+            return upload.data_uri, upload
+
+        url, expires_at = self._file_urls.get(upload.digest, (None, 0))
+        if time.time() >= expires_at:
+            extension = upload.media_type.split("/")[-1]
+            async with self.concurrency:
+                file = await self.client.files.async_create(
+                    BytesIO(upload.data),
+                    filename=f"{upload.digest[:16]}.{extension}",
+                    content_type=upload.media_type,
+                )
+            url = file.urls["get"]
+            expires_at = time.time() + self.FILE_REUSE_SECONDS
+            if file.expires_at:
+                expires_at = min(expires_at, datetime.fromisoformat(file.expires_at).timestamp() - 60)
+            self._file_urls[upload.digest] = (url, expires_at)
+            print(f"📁 Uploaded {file.name} to {url}")
+        return url, upload
 
-    def _extract_boxes(self, output: Dict[str, Any], image_size: tuple) -> List[List[float]]:
+    def _extract_detections(self, output: Dict[str, Any], image_size: tuple) -> tuple[List[List[float]], List[float]]:
         """
-        Extract bounding boxes from Replicate output.
+        Extract bounding boxes from Replicate output, along with their
+        confidence (1 if there's none).
         Handles both normalized (0-1) and pixel coordinates.
-        Format: [[x1, y1, x2, y2], ...]
+        Format: [[x1, y1, x2, y2], ...], [score, ...]
         """
         boxes = []
+        scores = []
         
         if isinstance(output, dict):
             detections = output.get("detections", [])
@@ -180,7 +302,7 @@ class ReplicateAnalyzer(ImageAnalyzerInterface):
             if not detections:
                 print(f"⚠️  No detections found in output")
                 print(f"    Output keys: {list(output.keys())}")
-                return boxes
+                return boxes, scores
             
             print(f"✅ Found {len(detections)} detections")
             
@@ -212,13 +334,14 @@ class ReplicateAnalyzer(ImageAnalyzerInterface):
                         print(f"   Detection {i+1}: Converted normalized coords to pixels")
                     
                     boxes.append([x1, y1, x2, y2])
+                    scores.append(float(detection.get("confidence", detection.get("score", 1.0))))
                     
                     if i < 5 or (i + 1) == len(detections):  # Log first 5 and last
                         print(f"   Detection {i+1}: Box [{x1:.0f}, {y1:.0f}, {x2:.0f}, {y2:.0f}]")
                 else:
                     print(f"⚠️  Detection {i+1} missing bbox/box field: {detection}")
             
-        return boxes
+        return boxes, scores
 
     def _download_visualization(self, viz_url: str) -> Image.Image:
         """
@@ -1,32 +1,94 @@
 
+import asyncio
 import requests
 
 import torch
+from config import AnnotationFormat, LocalDevice, LocalQuantization
 from PIL import Image
-import matplotlib.pyplot as plt
 from PIL import ImageDraw, ImageFont
 from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
 from torchvision.ops import box_iou
 import os
 from typing import List, Dict, Any
 
+from .analysis_cache import analysis_cache
 from .analyzer_interface import ImageAnalyzerInterface
+from .annotation_encoding import save_annotation
+from .inference_worker import InferenceWorker
+from .tiled_inference import tiler
 
 
 class SatelliteAnalyzer(ImageAnalyzerInterface):
     """
-    Local GPU-based analyzer using Grounding DINO.
-    Requires CUDA and transformers library.
+    Local analyzer using Grounding DINO, on a CUDA GPU or on CPU.
+    Requires the transformers library.
     """
 
-    def __init__(self):
-        self.images = {}
+    MODEL_VERSION = "IDEA-Research/grounding-dino-base"
+    MODEL_FAMILY = "IDEA-Research/grounding-dino"
 
-        model_id = "IDEA-Research/grounding-dino-base"
-        self.device = "cuda"
+    def __init__(
+        self,
+        device: LocalDevice = LocalDevice.AUTO,
+        quantization: LocalQuantization = LocalQuantization.INT8,
+        intra_op_threads: int = 0,
+        inter_op_threads: int = 0,
+        batch_size: int = 4,
+        batch_window: float = 0.01,
+    ):
+        """
+        Load the model onto the device.
+
+        Args:
+            device: "cuda", "cpu", or "auto" for CUDA if it's available
+            quantization: "int8" quantizes the model's linear layers dynamically
+                (weights ahead of time, activations on the fly) on CPU, which is
+                where the bulk of its compute is; ignored on CUDA
+            intra_op_threads: Threads used within an operation (0 for PyTorch's default)
+            inter_op_threads: Threads used across operations (0 for PyTorch's default)
+            batch_size: Images (or windows of them) per forward pass at most,
+                halved for good whenever a batch runs out of memory
+            batch_window: How long (s) the inference worker waits for images
+                of concurrent analyses to batch with the first one's
+        """
+        self.images = {}
+        self.batch_size = max(1, batch_size)
+
+        model_id = self.MODEL_VERSION
+        if device == LocalDevice.AUTO:
+            device = LocalDevice.CUDA if torch.cuda.is_available() else LocalDevice.CPU
+        self.device = device.value
+
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+        if inter_op_threads:
+            try:
+                torch.set_num_interop_threads(inter_op_threads)
+            except RuntimeError as e:
+                # only possible before any inter-op parallel work started
+                print(f"⚠️  Couldn't set inter-op threads: {e}")
 
         self.processor = AutoProcessor.from_pretrained(model_id)
-        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(self.device)
+        self.model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(self.device).eval()
+
+        self.quantization = LocalQuantization.NONE
+        if self.device == "cpu" and quantization == LocalQuantization.INT8:
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+            self.quantization = quantization
+
+        print(f"🧠 Loaded {model_id} on {self.device} ({self.quantization.value}, {torch.get_num_threads()} threads)")
+
+        # inference runs on a thread of its own, off the event loop
+        self.worker = InferenceWorker(self.detect_many, self.batch_size, batch_window, name="local-inference")
+
+    @property
+    def settings(self):
+        """What changes the detections besides the model, e.g. to key cached ones by."""
+
+        settings = [tiler.signature]
+        if self.quantization != LocalQuantization.NONE:
+            settings.append(self.quantization.value)
+        return ",".join(setting for setting in settings if setting) or None
 
     async def analyze_images(
         self,
@@ -36,30 +98,51 @@ class SatelliteAnalyzer(ImageAnalyzerInterface):
         image_names: List[str],
         box_threshold: float = 0.2,
         text_threshold: float = 0.9,
+        output_format: AnnotationFormat = AnnotationFormat.PNG,
+        output_quality: int = 80,
     ) -> List[Dict[str, Any]]:
         """
-        Async wrapper for local model inference.
+        Async wrapper for local model inference. The images are queued for
+        the inference worker, which batches them with those of concurrent
+        analyses for the same prompt and thresholds (see `detect_many`);
+        annotating them runs on a thread as well.
         """
+        batch_results = await self.worker.submit(images, (analysis_type, box_threshold, text_threshold))
+
+        return await asyncio.to_thread(
+            self.annotate, images, batch_results, analysis_type, image_id, image_names,
+            box_threshold, text_threshold, output_format, output_quality,
+        )
+
+    def annotate(self, images, batch_results, analysis_type, image_id, image_names, box_threshold, text_threshold, output_format, output_quality):
         results = []
-        for image, image_name in zip(images, image_names):
-            count, boxes, _ = self.counting(
+        for image, image_name, image_results in zip(images, image_names, batch_results):
+            count, boxes, image_with_boxes = self.counting(
                 image, 
                 analysis_type, 
                 plot=True, 
                 box_threshold=box_threshold, 
                 text_threshold=text_threshold, 
                 image_id=image_id, 
-                image_name=image_name
+                image_name=image_name,
+                results=image_results,
             )
             print(f"Number of {analysis_type} in the image: {count}")
+            # encode the annotated image once, returning it as well as saving it
             results.append({
                 "count": count,
                 "boxes": boxes.tolist() if hasattr(boxes, 'tolist') else boxes,
-                "image_path": f"processed_data/{image_id}/{image_name}.png"
+                **save_annotation(image_with_boxes, image_id, image_name, analysis_type, output_format, output_quality),
             })
 
         return results
 
+    def stats(self):
+        return {
+            "batch_size": self.batch_size,
+            "inference_worker": self.worker.stats(),
+        }
+
     def find_jpgs(self, directory):
         return [f for f in os.listdir(directory) if f.endswith('.jpg')]
 
@@ -88,6 +171,7 @@ class SatelliteAnalyzer(ImageAnalyzerInterface):
 
         return image
 
+    @staticmethod
     def remove_overlapping_boxes_from_results(results, iou_threshold=0.5):
         """
         Removes overlapping bounding boxes from results dictionary, keeping the smaller box.
@@ -145,37 +229,134 @@ class SatelliteAnalyzer(ImageAnalyzerInterface):
 
         return filtered_results
 
-    def counting(self, image, looking_for, plot=True, box_threshold=0.2, text_threshold=0.9, image_id=None, image_name=None):
-        text = f"{looking_for}."
+    def detect(self, image, looking_for, box_threshold=0.2, text_threshold=0.9):
+        """
+        Runs Grounding DINO on each window of an image (see `Tiler`), unless
+        the analysis cache has its detections already. Returns them
+        post-processed and merged across windows, as a list with one dict of
+        "boxes", "scores" and "labels".
+        """
+        return self.detect_many([image], looking_for, box_threshold, text_threshold)[:1]
+
+    def detect_many(self, images, looking_for, box_threshold=0.2, text_threshold=0.9):
+        """
+        Like `detect`, for several images at once: the windows of all images
+        whose detections aren't cached are run through the model in batches.
+        Returns one dict of "boxes", "scores" and "labels" per image.
+        """
+        cache_keys = [
+            analysis_cache.key(image, looking_for, box_threshold, text_threshold, self.MODEL_VERSION, self.settings)
+            for image in images
+        ]
+        detections = [analysis_cache.get(cache_key) for cache_key in cache_keys]
+
+        missing = [i for i, image_detections in enumerate(detections) if image_detections is None]
+        if missing:
+            computed = self.detect_windows([images[i] for i in missing], looking_for, box_threshold, text_threshold)
+            for i, image_detections in zip(missing, computed):
+                detections[i] = image_detections
+                analysis_cache.put(cache_keys[i], image_detections)
+
+        return [{
+            "boxes": torch.tensor(image_detections["boxes"], dtype=torch.float32).reshape(-1, 4),
+            "scores": torch.tensor(image_detections["scores"], dtype=torch.float32),
+            "labels": image_detections["labels"],
+        } for image_detections in detections]
+
+    def detect_windows(self, images, looking_for, box_threshold=0.2, text_threshold=0.9):
+        """
+        Runs Grounding DINO on the windows of all images (in batches, see
+        `infer`), returning each image's count, boxes, scores and labels
+        merged across its windows as plain lists.
+        """
+        crops_per_image = [tiler.crops(image) for image in images]
+        window_results = self.infer(
+            [crop for crops in crops_per_image for _, crop in crops],
+            looking_for,
+            box_threshold,
+            text_threshold,
+        )
+
+        detections = []
+        start = 0
+        for crops in crops_per_image:
+            image_results = window_results[start:start + len(crops)]
+            start += len(crops)
+
+            boxes, scores, keep = tiler.merge(
+                [window for window, _ in crops],
+                [result["boxes"].tolist() for result in image_results],
+                [result["scores"].tolist() for result in image_results],
+            )
+            labels = [str(label) for result in image_results for label in result["labels"]]
+            detections.append({
+                "count": len(boxes),
+                "boxes": boxes,
+                "scores": scores,
+                "labels": [labels[i] for i in keep],
+            })
+        return detections
+
+    def infer(self, images, looking_for, box_threshold=0.2, text_threshold=0.9):
+        """
+        Runs Grounding DINO on images in batches of up to `batch_size`, with
+        the prompt tokenized once. Images of a batch are padded to the same
+        size (the pixel mask keeps padding out of the detections), and the
+        results are post-processed per image. A batch running out of memory
+        is retried at half the size, which sticks for later batches.
+        """
+        text_inputs = self.processor.tokenizer(f"{looking_for}.", return_tensors="pt")
+
+        results = []
+        start = 0
+        while start < len(images):
+            batch = images[start:start + self.batch_size]
+            try:
+                results.extend(self._infer_batch(batch, text_inputs, box_threshold, text_threshold))
+            except RuntimeError as e:
+                # torch.cuda.OutOfMemoryError is a RuntimeError, as are CPU allocation failures
+                if self.batch_size == 1 or not ("out of memory" in str(e) or "can't allocate memory" in str(e)):
+                    raise
+                self.batch_size = max(1, len(batch) // 2)
+                if self.device == "cuda":
+                    torch.cuda.empty_cache()
+                print(f"⚠️  Out of memory for a batch of {len(batch)}, reducing the batch size to {self.batch_size}")
+                continue
+            start += len(batch)
+
+        return results
+
+    def _infer_batch(self, images, text_inputs, box_threshold, text_threshold):
+        inputs = self.processor.image_processor(images=images, return_tensors="pt")
+        for name, tensor in text_inputs.items():
+            inputs[name] = tensor.expand(len(images), -1)
+        inputs = inputs.to(self.device)
 
-        inputs = self.processor(images=image, text=text, return_tensors="pt").to(self.device)
         with torch.no_grad():
             outputs = self.model(**inputs)
 
-        results = self.processor.post_process_grounded_object_detection(
+        return self.processor.post_process_grounded_object_detection(
             outputs,
-            inputs.input_ids,
+            inputs["input_ids"],
             box_threshold=box_threshold,
             text_threshold=text_threshold,
-            target_sizes=[image.size[::-1]]
+            target_sizes=[image.size[::-1] for image in images]
         )
 
+    def counting(self, image, looking_for, plot=True, box_threshold=0.2, text_threshold=0.9, image_id=None, image_name=None, results=None):
+        """
+        Counts (and plots) the detections of an image, running `detect`
+        unless its `results` (one dict, see `detect_many`) are at hand.
+        """
+        if results is None:
+            results = self.detect(image, looking_for, box_threshold, text_threshold)
+        else:
+            results = [results]
+
         if plot:
             image_with_boxes = self.plot_boxes(image.copy(), self.remove_overlapping_boxes_from_results(results[0], 0.5))
             count_boxes = len(results[0]["boxes"])
 
-            plt.figure(figsize=(10, 10))
-            plt.imshow(image_with_boxes)
-            plt.axis("off")
-            # plt.show()
-            
-            # Create a directory data/processed if it doesn't exist
-            os.makedirs("data/processed", exist_ok=True)
-
-            # Create processed_data/{image_id} folder if it doesn't exist
-            os.makedirs(f"processed_data/{image_id}", exist_ok=True)
-            plt.savefig(f"processed_data/{image_id}/{image_name}.png")
-
             print(f"Number of {looking_for} in the image: {count_boxes}")
 
             return count_boxes, results[0]["boxes"], image_with_boxes
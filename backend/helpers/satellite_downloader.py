@@ -1,10 +1,9 @@
+import asyncio
 import uuid
 import io
 import math
 import os
-import re
 import random
-import sys
 import time
 from datetime import datetime
 
@@ -13,19 +12,24 @@ import argparse
 import concurrent.futures
 import threading
 
+import httpx
 import requests
 
-from PIL import Image, ImageOps, ImageChops
+from PIL import Image, ImageOps
 Image.MAX_IMAGE_PIXELS = None
 
+from config import config
 
-TILE_SIZE = 256  # in pixels
-EARTH_CIRCUMFERENCE = 40075.016686 * 1000  # in meters, at the equator
+from .tile_cache import tile_cache
+from .tile_fetcher import async_mode, tile_fetcher
+from .tile_fingerprint import exact_hash, hamming_distance, perceptual_hash
+from .tile_session import tile_session
+from .version_index import VersionIndex, version_index
+from .version_resolver import version_resolver
 
-USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36"
 
-DEFAULT_VERSION = 908
-DEFAULT_OBLIQUE_VERSION = 131  # both as of early October, 2021
+TILE_SIZE = 256  # in pixels
+EARTH_CIRCUMFERENCE = 40075.016686 * 1000  # in meters, at the equator
 
 
 class ViewDirection:
@@ -271,51 +275,141 @@ class MapTile:
         # initialize the other variables
         self.status = MapTileStatus.PENDING
         self.image = None
+        self.fingerprint = None
+        self.phash = None
 
     def __repr__(self):
         return f"MapTile({self.version}, {self.zoom}, {self.direction}, {self.x}, {self.y})"
 
-    def load(self):
+    def quadkey(self):
+        """
+        The Bing Maps-style quadkey of the tile's position (irrespective of its
+        version), which interleaves the bits of x and y. See
+        https://learn.microsoft.com/en-us/bingmaps/articles/bing-maps-tile-system
+        """
+
+        digits = []
+        for i in range(self.zoom, 0, -1):
+            mask = 1 << (i - 1)
+            digit = 0
+            if self.x & mask:
+                digit += 1
+            if self.y & mask:
+                digit += 2
+            digits.append(str(digit))
+        return "".join(digits)
+
+    def load(self, on_load=None):
         """
-        Downloads the tile image if it hasn't been downloaded yet. Can be used
-        for retrying on errors.
+        Loads the tile image if it hasn't been loaded yet, from the tile cache
+        if possible and otherwise from the network. Can be used for retrying on
+        errors. If given, `on_load` is called with the tile once it's available.
         """
 
         if self.status != MapTileStatus.DOWNLOADED:
-            self.download()
+            data = tile_cache.get(self)
+            if data is not None:
+                self.decode(data)
+            else:
+                self.download()
 
+        if on_load and self.status == MapTileStatus.DOWNLOADED:
+            on_load(self)
 
     def download(self):
         """
-        Downloads a tile image. Sets the status to ERROR if things don't work
-        out for whatever reason.
+        Downloads a tile image, retrying transient errors with jittered
+        exponential backoff as per the fetch policy. Sets the status to ERROR
+        if things don't work out for whatever reason.
         """
 
         self.status = MapTileStatus.DOWNLOADING
 
-        try:
-            url_template = "https://khms1.google.com/kh/v={version}?x={x}&y={y}&z={zoom}"
-            if self.direction.is_oblique():
-                url_template = "https://khms1.googleapis.com/kh?v={version}&deg={angle}&x={x}&y={y}&z={zoom}"
-            url = url_template.format(version=self.version, angle=self.direction.angle, x=self.x, y=self.y, zoom=self.zoom)
-            r = requests.get(url, headers={"User-Agent": USER_AGENT})
-        except requests.exceptions.ConnectionError:
-            self.status = MapTileStatus.ERROR
+        policy = config.TILE_FETCH_POLICY
+        for attempt in range(policy.max_retries + 1):
+            if attempt:
+                time.sleep(policy.backoff(attempt))
+
+            try:
+                r = tile_session.get(self, timeout=policy.timeout)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                continue
+
+            # error handling
+            if r.status_code != 200:
+                if policy.retryable(r.status_code):
+                    continue
+                break
+
+            # convert response into an image, only caching it once that's worked
+            data = r.content
+            self.decode(data)
+            tile_cache.put(self, data, self.fingerprint)
             return
 
-        # error handling
-        if r.status_code != 200:
-            self.status = MapTileStatus.ERROR
+        self.status = MapTileStatus.ERROR
+
+    async def load_async(self, on_load=None):
+        """
+        Like `load`, but downloads through the asyncio tile fetcher. Must run
+        on the fetcher's event loop, see `AsyncTileFetcher.load`.
+        """
+
+        if self.status != MapTileStatus.DOWNLOADED:
+            data = tile_cache.get(self)
+            if data is not None:
+                self.decode(data)
+            else:
+                await self.download_async()
+
+        if on_load and self.status == MapTileStatus.DOWNLOADED:
+            on_load(self)
+
+    async def download_async(self):
+        """Like `download`, but non-blocking. Same status semantics."""
+
+        self.status = MapTileStatus.DOWNLOADING
+
+        policy = config.TILE_FETCH_POLICY
+        for attempt in range(policy.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(policy.backoff(attempt))
+
+            try:
+                r = await tile_fetcher.get(self)
+            except httpx.TransportError:
+                continue
+
+            # error handling
+            if r.status_code != 200:
+                if policy.retryable(r.status_code):
+                    continue
+                break
+
+            data = r.content
+            self.decode(data)
+            tile_cache.put(self, data, self.fingerprint)
             return
 
-        # convert response into an image
-        data = r.content
+        self.status = MapTileStatus.ERROR
+
+    def decode(self, data):
+        """
+        Converts raw tile bytes into an image, fingerprints them and marks the
+        tile as done. Pixels are only decoded here if perceptual hashing is
+        enabled, otherwise not until they're first needed.
+        """
+
         self.image = Image.open(io.BytesIO(data))
 
         # sanity check
         assert self.image.mode == "RGB"
         assert self.image.size == (TILE_SIZE, TILE_SIZE)
 
+        self.fingerprint = exact_hash(data)
+        if config.TILE_PERCEPTUAL_HASH:
+            self.phash = perceptual_hash(self.image)
+
         # done!
         self.status = MapTileStatus.DOWNLOADED
 
@@ -326,8 +420,9 @@ class ProgressIndicator:
     to run in a separate thread, polling for status updates frequently.
     """
 
-    def __init__(self, maptilegrid):
+    def __init__(self, maptilegrid, cancelled=None):
         self.maptilegrid = maptilegrid
+        self.cancelled = cancelled or threading.Event()
 
     def update_tile(self, maptile):
         """
@@ -349,10 +444,8 @@ class ProgressIndicator:
         elif maptile.status == MapTileStatus.ERROR:
             p("\033[41m\033[37m" + "XX")
 
-    def update_text(self):
-        """
-        Displays percentage and counts only.
-        """
+    def counts(self):
+        """Counts downloaded and failed tiles, and returns them with the total."""
 
         downloaded = 0
         errors = 0
@@ -363,6 +456,14 @@ class ProgressIndicator:
                 errors += 1
 
         total = self.maptilegrid.width * self.maptilegrid.height
+        return downloaded, errors, total
+
+    def update_text(self):
+        """
+        Displays percentage and counts only.
+        """
+
+        downloaded, errors, total = self.counts()
         percent = int(10 * (100 * downloaded / total)) / 10
 
         details = f"{downloaded}/{total}"
@@ -395,9 +496,9 @@ class ProgressIndicator:
     def loop(self):
         """Main loop."""
 
-        while any([maptile.status is MapTileStatus.PENDING or
-                   maptile.status is MapTileStatus.DOWNLOADING
-                   for maptile in self.maptilegrid.flat()]):
+        while not self.cancelled.is_set() and any([maptile.status is MapTileStatus.PENDING or
+                                                   maptile.status is MapTileStatus.DOWNLOADING
+                                                   for maptile in self.maptilegrid.flat()]):
             self.update()
             time.sleep(0.1)
         self.update()  # final update to show that we're all done
@@ -420,6 +521,57 @@ class MissingTilesError(Exception):
         return self.message
 
 
+class DownloadCancelled(Exception):
+    """Exception raised when a download is cancelled while in progress."""
+
+
+class DownloadProgress:
+    """
+    Tracks the progress of a `SatelliteDownloader.download` call for status
+    reporting (e.g. by the job API), and allows cancelling it. The tile
+    counts of the grid currently being downloaded come straight from its
+    `ProgressIndicator`.
+    """
+
+    def __init__(self):
+        self.phase = "pending"
+        self.image_id = None
+        self.scanner = None
+        self.versions = []
+        self.completed_versions = []
+        self.current_version = None
+        self.grid = None
+        self.cancelled = threading.Event()
+
+    def __repr__(self):
+        return f"DownloadProgress({self.phase}, {len(self.completed_versions)}/{len(self.versions)})"
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check(self):
+        """Raises a `DownloadCancelled` if the download has been cancelled."""
+
+        if self.cancelled.is_set():
+            raise DownloadCancelled(f"download {self.image_id} was cancelled")
+
+    def to_dict(self):
+        tiles = None
+        if self.grid is not None:
+            downloaded, errors, total = ProgressIndicator(self.grid).counts()
+            tiles = {"downloaded": downloaded, "errors": errors, "total": total}
+
+        return {
+            "phase": self.phase,
+            "image_id": str(self.image_id) if self.image_id else None,
+            "probed_versions": self.scanner.probes if self.scanner else 0,
+            "versions": self.versions,
+            "completed_versions": self.completed_versions,
+            "current_version": self.current_version,
+            "current_version_tiles": tiles,
+        }
+
+
 class MapTileGrid:
     """
     A grid of map tiles, kepts as a nested list such that indexing works via
@@ -486,14 +638,22 @@ class MapTileGrid:
 
         return [maptile for col in self.maptiles for maptile in col]
 
-    def download(self):
+    def download(self, on_load=None, cancelled=None):
         """
-        Downloads the constitudent tiles using a threadpool for performance
-        while updating the progress indicator.
+        Downloads the constitudent tiles concurrently while updating the
+        progress indicator. Uses the process-wide asyncio tile fetcher unless
+        the thread pool fallback mode is configured. `on_load` is called with
+        each tile as soon as it's available, e.g. for streaming stitching.
+        Setting the `cancelled` event stops the download as soon as possible,
+        raising a `DownloadCancelled`.
         """
 
+        if async_mode():
+            tile_fetcher.run(self.download_async(on_load, cancelled))
+            return
+
         # set up progress indicator
-        prog = ProgressIndicator(self)
+        prog = ProgressIndicator(self, cancelled)
         prog_thread = threading.Thread(target=prog.loop)
         prog_thread.start()
 
@@ -506,21 +666,73 @@ class MapTileGrid:
         # [maptile.load() for maptile in self.flat()]), see
         # https://docs.python.org/dev/library/concurrent.futures.html#threadpoolexecutor-example
         threads = max(self.width, self.height)
+        tile_session.ensure_pool_size(threads)
         with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
-            {executor.submit(maptile.load): maptile for maptile in tiles}
+            self.wait_or_cancel([executor.submit(maptile.load, on_load) for maptile in tiles], cancelled)
+
+            # retry failed downloads (in parallel) if fewer than 20% of tiles
+            # are missing
+            missing_tiles = [maptile for maptile in self.flat() if maptile.status == MapTileStatus.ERROR]
+            if 0 < len(missing_tiles) < 0.2 * len(self.flat()):
+                print("Retrying missing tiles...")
+                self.wait_or_cancel([executor.submit(maptile.load, on_load) for maptile in missing_tiles], cancelled)
+
+        # finish up progress indicator
+        prog_thread.join()
+        prog.cleanup()
+
+        self.raise_for_missing_tiles(cancelled)
+
+    async def download_async(self, on_load=None, cancelled=None):
+        """
+        Downloads the constitudent tiles through the asyncio tile fetcher,
+        awaitable from any event loop (e.g. in a FastAPI handler).
+        """
+
+        prog = ProgressIndicator(self, cancelled)
+        prog_thread = threading.Thread(target=prog.loop)
+        prog_thread.start()
+
+        tiles = self.flat()
+        random.shuffle(tiles)
+        await tile_fetcher.load(tiles, on_load, cancelled)
 
         # retry failed downloads if fewer than 20% of tiles are missing
         missing_tiles = [maptile for maptile in self.flat() if maptile.status == MapTileStatus.ERROR]
-        if 0 < len(missing_tiles) < 0.2 * len(self.flat()):
+        if 0 < len(missing_tiles) < 0.2 * len(self.flat()) and not prog.cancelled.is_set():
             print("Retrying missing tiles...")
-            for maptile in missing_tiles:
-                maptile.load()
+            await tile_fetcher.load(missing_tiles, on_load, cancelled)
 
-        # finish up progress indicator
-        prog_thread.join()
+        # the progress indicator exits within one polling interval by now
+        await asyncio.to_thread(prog_thread.join)
         prog.cleanup()
 
-        # check if we've got everything now
+        self.raise_for_missing_tiles(cancelled)
+
+    @staticmethod
+    def wait_or_cancel(futures, cancelled=None):
+        """
+        Waits for thread pool futures, cancelling those that haven't started
+        yet once the `cancelled` event is set.
+        """
+
+        not_done = futures
+        while not_done:
+            _, not_done = concurrent.futures.wait(not_done, timeout=0.1)
+            if cancelled is not None and cancelled.is_set():
+                for future in not_done:
+                    future.cancel()
+                return
+
+    def raise_for_missing_tiles(self, cancelled=None):
+        """
+        Raises a `DownloadCancelled` if the download has been cancelled, and
+        a `MissingTilesError` unless every tile has been loaded.
+        """
+
+        if cancelled is not None and cancelled.is_set():
+            raise DownloadCancelled("tile download was cancelled")
+
         missing_tiles = [maptile for maptile in self.flat() if maptile.status == MapTileStatus.ERROR]
         if missing_tiles:
             raise MissingTilesError(f"unable to download one or more map tiles", len(missing_tiles), len(self.flat()))
@@ -533,40 +745,18 @@ class MapTileGrid:
 
         return [self.at(x, y) for x in [0, -1] for y in [0, -1]]
 
-
-    def corners_identical_to(self, other):
+    @staticmethod
+    def load_tiles(maptiles, threads=8, cancelled=None):
         """
-        Checks whether the four corners of this grid are identical to the ones
-        from another grid. The other grid MUST already be fully loaded (or, at
-        least, its corners must be available).
+        Loads an arbitrary set of tiles concurrently, through the asyncio tile
+        fetcher or, in the fallback mode, a thread pool of the given size.
         """
 
-        self_corners = self.corners()
-        other_corners = other.corners()
-        assert all([maptile.status == MapTileStatus.DOWNLOADED for maptile in other_corners])
-
-        # download self's corners
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            {executor.submit(maptile.load): maptile for maptile in self_corners}
-
-        # retry
-        missing_tiles = [maptile for maptile in self_corners if maptile.status == MapTileStatus.ERROR]
-        for maptile in missing_tiles:
-            maptile.load()
-        missing_tiles = [maptile for maptile in self_corners if maptile.status == MapTileStatus.ERROR]
-        if missing_tiles:
-            raise MissingTilesError(f"unable to download one or more corner tiles", len(missing_tiles), len(self_corners))
-
-        # super basic difference metric: just sum up the differences of each
-        # channel for every pixel (for every corner) – you'd think this would be
-        # slow, but it takes 0.2s on my early 2015 laptop for all four combined
-        # (the connection setup latency during download is the limiting factor!)
-        for self_corner, other_corner in zip(self_corners, other_corners):
-            diff = ImageChops.difference(self_corner.image, other_corner.image)
-            if any([True for channels in list(diff.getdata()) if channels != (0, 0, 0)]):
-                return False
-
-        return True
+        if async_mode():
+            tile_fetcher.run(tile_fetcher.load(maptiles, cancelled=cancelled))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+                MapTileGrid.wait_or_cancel([executor.submit(maptile.load) for maptile in maptiles], cancelled)
 
     def stitch(self):
         """
@@ -581,15 +771,303 @@ class MapTileGrid:
         self.image = image
 
 
+class VersionScanner:
+    """
+    Finds the distinct imagery epochs of an area without walking through every
+    version one at a time. Versions are characterized by a signature of their
+    corner tiles (or `None` if they're unavailable, e.g. purged). The scanner
+    first probes every `stride`-th version, `batch` of them concurrently, until
+    it hits the end of the history (`max_purged` unavailable versions in a
+    row, after which the sequential walk used to give up too). Then it bisects
+    every interval between two probes with differing signatures, again probing
+    all midpoints of a round concurrently, until the exact versions where the
+    imagery changes are known. Intervals whose ends share a signature are
+    assumed to be unchanged throughout – that's the speculative part.
+    """
+
+    def __init__(self, georect, zoom, direction, stride=16, batch=8, max_purged=3, cancelled=None):
+        assert stride > 0 and batch > 0
+
+        self.cancelled = cancelled or threading.Event()
+        self.georect = georect
+        self.zoom = zoom
+        self.direction = direction
+        self.stride = stride
+        self.batch = batch
+        self.max_purged = max_purged
+
+        # version -> corner signature (None if unavailable), and the grids of
+        # available versions so their corner tiles needn't be loaded again
+        self.signatures = {}
+        self.grids = {}
+
+        # the newest version scanned so far and where the history ends (None
+        # if it goes all the way back to version 0)
+        self.known_through = None
+        self.known_end = None
+        self.probes = 0
+
+    def __repr__(self):
+        return f"VersionScanner({self.georect}, {self.zoom}, {self.direction})"
+
+    def probe(self, versions):
+        """
+        Concurrently downloads the corner tiles of all given versions that
+        haven't been probed yet and records their signatures.
+        """
+
+        grids = {
+            version: MapTileGrid.from_georect(self.georect, self.zoom, self.direction, version)
+            for version in set(versions)
+            if version >= 0 and version not in self.signatures
+        }
+        corners = [maptile for grid in grids.values() for maptile in grid.corners()]
+        MapTileGrid.load_tiles(corners, cancelled=self.cancelled)
+        self.probes += len(grids)
+
+        # retry once, concurrently, lest a hiccup be mistaken for a purge
+        missing_tiles = [maptile for maptile in corners if maptile.status == MapTileStatus.ERROR]
+        if missing_tiles:
+            MapTileGrid.load_tiles(missing_tiles, cancelled=self.cancelled)
+
+        if self.cancelled.is_set():
+            raise DownloadCancelled("version scan was cancelled")
+
+        for version, grid in grids.items():
+            if all(maptile.status == MapTileStatus.DOWNLOADED for maptile in grid.corners()):
+                self.signatures[version] = self.signature(grid)
+                self.grids[version] = grid
+            else:
+                self.signatures[version] = None
+
+    @staticmethod
+    def signature(grid):
+        """
+        Identifies a grid's imagery by the fingerprints of its corners, which
+        doesn't require decoding any pixels. With perceptual hashing enabled,
+        their perceptual hashes are used instead so that re-encoded but
+        otherwise identical imagery doesn't count as a change.
+        """
+
+        if config.TILE_PERCEPTUAL_HASH:
+            return tuple(f"{maptile.phash:016x}" for maptile in grid.corners())
+        return tuple(maptile.fingerprint for maptile in grid.corners())
+
+    @staticmethod
+    def same_imagery(a, b):
+        """
+        Whether two signatures show the same imagery: with perceptual hashing
+        enabled, if each of their corners' hashes differ in at most
+        `TILE_PHASH_MAX_DISTANCE` bits, otherwise if they're identical.
+        Unavailable versions (`None`) match nothing, not even each other, as
+        there's no telling what imagery lies between two of them.
+        """
+
+        if a is None or b is None:
+            return False
+        if not config.TILE_PERCEPTUAL_HASH:
+            return a == b
+        return len(a) == len(b) and all(
+            hamming_distance(int(x, 16), int(y, 16)) <= config.TILE_PHASH_MAX_DISTANCE
+            for x, y in zip(a, b)
+        )
+
+    def end_of_history(self, version):
+        """Whether an unavailable version is followed by enough others."""
+
+        below = [v for v in range(version - 1, version - 1 - self.max_purged, -1) if v >= 0]
+        self.probe(below)
+        return all(self.signatures[v] is None for v in below)
+
+    def seed(self, entry):
+        """
+        Seeds the scanner with a previous scan's results as stored in the
+        `VersionIndex`, such that only versions newer than those need probing.
+        """
+
+        for newest, oldest, signature in entry["ranges"]:
+            signature = tuple(signature) if signature is not None else None
+            self.signatures.setdefault(newest, signature)
+            self.signatures.setdefault(oldest, signature)
+
+        self.known_through = entry["current"]
+        self.known_end = entry["end"]
+
+    def scan(self, current_version):
+        """
+        Returns the newest version of every distinct epoch, newest first.
+        Empty if not even the current version is available.
+        """
+
+        end = self.known_end
+        if self.known_through is None or current_version > self.known_through:
+            self.probe([current_version])
+            if self.signatures[current_version] is None:
+                return []
+
+            # speculative sampling of the (not yet known part of the) history
+            samples = []
+            end = None
+            version = current_version
+            while version >= 0 and end is None:
+                batch = [version - i * self.stride for i in range(self.batch)
+                         if version - i * self.stride >= 0
+                         and (self.known_through is None or version - i * self.stride > self.known_through)]
+                if not batch:
+                    break
+                self.probe(batch)
+                for sample in batch:
+                    if self.signatures[sample] is None and self.end_of_history(sample):
+                        end = sample
+                        break
+                    samples.append(sample)
+                version = batch[-1] - self.stride
+
+            # the end, if any, bounds the last interval – otherwise, connect to
+            # the known part of the history or make sure the oldest versions
+            # are covered
+            if end is not None:
+                samples.append(end)
+            elif self.known_through is not None:
+                samples.append(self.known_through)
+                end = self.known_end
+            elif samples[-1] != 0:
+                self.probe([0])
+                samples.append(0)
+
+            # change-point search between samples, all intervals in lockstep
+            intervals = list(zip(samples, samples[1:]))
+            while intervals:
+                intervals = [(newer, older) for newer, older in intervals
+                             if newer - older > 1 and not self.same_imagery(self.signatures[newer], self.signatures[older])]
+                self.probe([(newer + older) // 2 for newer, older in intervals])
+                intervals = [interval for newer, older in intervals
+                             for interval in ((newer, (newer + older) // 2), ((newer + older) // 2, older))]
+
+            self.known_through = current_version
+            self.known_end = end
+
+        # each change of (available) imagery starts a new epoch
+        epochs = []
+        previous_signature = None
+        for version, signature in self.history(current_version):
+            if signature is not None and not self.same_imagery(signature, previous_signature):
+                epochs.append(version)
+                previous_signature = signature
+
+        return epochs
+
+    def history(self, current_version=None):
+        """
+        The known signatures within the scanned part of the history, from the
+        given (or newest known) version downwards.
+        """
+
+        current_version = self.known_through if current_version is None else current_version
+        history = [
+            (version, self.signatures[version])
+            for version in sorted(self.signatures, reverse=True)
+            if version <= current_version and (self.known_end is None or version > self.known_end)
+        ]
+
+        # a current version in between two known ones shares the signature of
+        # both (otherwise, they'd be adjacent)
+        if history and history[0][0] != current_version and current_version < self.known_through:
+            history.insert(0, (current_version, history[0][1]))
+
+        return history
+
+    def ranges(self):
+        """
+        Summarizes the scanned history as [newest, oldest, signature] ranges
+        of versions sharing a signature, newest first. Signatures of `None`
+        mark purged or otherwise unavailable versions, and ranges whose
+        signature equals an earlier one's hold duplicate imagery.
+        """
+
+        ranges = []
+        for version, signature in self.history():
+            # the scan probes every version between two unavailable ones, so
+            # consecutive ones can share a range
+            if ranges and (ranges[-1][2] is signature is None or self.same_imagery(ranges[-1][2], signature)):
+                ranges[-1][1] = version
+            else:
+                ranges.append([version, version, signature])
+
+        return ranges
+
+    def to_entry(self):
+        """The counterpart of `seed`, for storage in the `VersionIndex`."""
+
+        return {
+            "current": self.known_through,
+            "end": self.known_end,
+            "ranges": [[newest, oldest, list(signature) if signature is not None else None]
+                       for newest, oldest, signature in self.ranges()],
+        }
+
+
+class StreamingStitcher:
+    """
+    Assembles the final, already cropped image of a grid while its tiles are
+    still downloading: the canvas is allocated once at the size of the
+    `GeoRect`'s pixel window, and only the part of each tile that falls within
+    that window is pasted as soon as the tile is available. This overlaps
+    decoding with network I/O and saves the full-size intermediate images of
+    `MapTileGrid.stitch` followed by `MapTileImage.crop`.
+    """
+
+    def __init__(self, grid, zoom, direction, georect):
+        self.grid = grid
+        self.origin = grid.at(0, 0)
+
+        left_crop, top_crop, right_crop, bottom_crop = MapTileImage.crop_borders(zoom, direction, georect)
+        self.window = (
+            left_crop,
+            top_crop,
+            grid.width * TILE_SIZE - right_crop,
+            grid.height * TILE_SIZE - bottom_crop
+        )
+
+        left, top, right, bottom = self.window
+        self.image = Image.new("RGB", (right - left, bottom - top))
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"StreamingStitcher({self.window})"
+
+    def paste(self, maptile):
+        """
+        Pastes the visible part of a loaded tile. Safe to call concurrently
+        from download threads, and meant to be passed as `on_load` callback.
+        """
+
+        # position of the tile within the full grid, in pixels
+        x0 = (maptile.x - self.origin.x) * TILE_SIZE
+        y0 = (maptile.y - self.origin.y) * TILE_SIZE
+
+        # intersection with the window, skipping tiles that are cropped away
+        left, top, right, bottom = self.window
+        box = (max(left, x0), max(top, y0), min(right, x0 + TILE_SIZE), min(bottom, y0 + TILE_SIZE))
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return
+
+        region = maptile.image.crop((box[0] - x0, box[1] - y0, box[2] - x0, box[3] - y0))
+        with self._lock:
+            self.image.paste(region, (box[0] - left, box[1] - top))
+
+
 class MapTileImage:
     """Image cropping, resizing and enhancement."""
 
     def __init__(self, image, version):
+        self.path = None
         self.image = image
         self.version = version
 
     def save(self, path, quality=90):
         self.image.save(path, quality=quality)
+        self.path = path
 
     def crop(self, zoom, direction, georect):
         """
@@ -597,6 +1075,16 @@ class MapTileImage:
         input `GeoRect`. This function must only be called once per image.
         """
 
+        # snip snap
+        self.image = ImageOps.crop(self.image, self.crop_borders(zoom, direction, georect))
+
+    @staticmethod
+    def crop_borders(zoom, direction, georect):
+        """
+        Computes how many pixels need to be cut off the (left, top, right,
+        bottom) edges of the stitched grid covering the input `GeoRect`.
+        """
+
         left, bottom = WebMercator.project(georect.sw, zoom)  # sw_x, sw_y
         right, top = WebMercator.project(georect.ne, zoom)  # ne_x, ne_y
         if direction.is_oblique():
@@ -616,10 +1104,7 @@ class MapTileImage:
         right_crop = round(TILE_SIZE * (1 - right % 1))
         top_crop = round(TILE_SIZE * (top % 1))
 
-        crop = (left_crop, top_crop, right_crop, bottom_crop)
-
-        # snip snap
-        self.image = ImageOps.crop(self.image, crop)
+        return (left_crop, top_crop, right_crop, bottom_crop)
 
     def scale(self, width, height):
         """
@@ -632,9 +1117,13 @@ class MapTileImage:
         self.image = self.image.resize((round(width), round(height)), resample=Image.LANCZOS)
 
     def tobytes(self):
-        # Convert image to bytes and encode as base64 for safe transmission
+        # Convert image to bytes and encode as base64 for safe transmission,
+        # reusing the saved file rather than encoding it once more if possible
         import base64
         import io
+        if self.path is not None:
+            with open(self.path, "rb") as f:
+                return base64.b64encode(f.read()).decode('utf-8')
         img_byte_arr = io.BytesIO()
         self.image.save(img_byte_arr, format='JPEG')
         img_byte_arr = img_byte_arr.getvalue()
@@ -662,18 +1151,26 @@ class SatelliteDownloader:
     def __init__(self):
         pass
 
-    def download(self, latitude: float, longitude: float, zoom: int=1000):
+    def download(self, latitude: float, longitude: float, zoom: int=1000, progress: DownloadProgress=None, on_image=None):
+        """
+        Downloads every distinct imagery version of the area around the given
+        point, newest first. `on_image(image_id, image, metadata)` is called
+        with each version's image as soon as it's been saved, e.g. to stream it
+        to a client instead of waiting for the whole history.
+        """
+
         # Generate an image_id
         image_id = uuid.uuid4()
 
+        # progress is reported to (and cancellation requested by) the caller
+        progress = progress or DownloadProgress()
+        progress.image_id = image_id
+        progress.phase = "resolving"
+
         # process options
         p = GeoPoint(latitude, longitude)
         direction = ViewDirection("downward")
 
-        current_version = DEFAULT_VERSION
-        if direction.is_oblique():
-            current_version = DEFAULT_OBLIQUE_VERSION
-
         width = zoom
         height = zoom
 
@@ -692,7 +1189,8 @@ class SatelliteDownloader:
 
         quality = 90
 
-        image_path_template = "data/{image_id}/googlemapsat88mph-{datetime}-{direction}-v{versions}-x{xmin}..{xmax}y{ymin}..{ymax}-z{zoom}-{latitude},{longitude}-{width}x{height}m"
+        # under the same root the image store and manifest read them from
+        image_path_template = os.path.join(config.DATA_DIR, "{image_id}", "googlemapsat88mph-{datetime}-{direction}-v{versions}-x{xmin}..{xmax}y{ymin}..{ymax}-z{zoom}-{latitude},{longitude}-{width}x{height}m")
 
         foreshortening_factor = 1
         if direction.is_oblique():
@@ -727,17 +1225,8 @@ class SatelliteDownloader:
         ############################################################################
 
         print("Determining current Google Maps version (we'll work our way backwards from there)...")
-        try:
-            google_maps_page = requests.get("https://maps.googleapis.com/maps/api/js", headers={"User-Agent": USER_AGENT}).content
-            match = re.search(rb'null,\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)', google_maps_page)
-            if direction.is_oblique():
-                match = re.search(rb'\],\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)', google_maps_page)
-            if match:
-                current_version = int(match.group(1).decode("ascii"))
-            else:
-                print(f"Unable to extract current version, proceeding with outdated version {current_version} instead.")
-        except requests.RequestException:
-            print(f"Unable to load Google Maps, proceeding with outdated version {current_version} instead.")
+        current_version = version_resolver.current_version(direction.is_oblique())
+        print(current_version)
 
         print("Computing required tile zoom level at specified point...")
         zoom = p.compute_zoom_level(max_meters_per_pixel)
@@ -751,41 +1240,50 @@ class SatelliteDownloader:
 
         print("Alrighty, prep work's done!")
 
-        previous_grid = None
+        print("Scanning the version history for distinct imagery (corner tiles only)...")
+        progress.check()
+        progress.phase = "scanning"
+        scanner = VersionScanner(
+            rect, zoom, direction,
+            stride=config.VERSION_SCAN_STRIDE,
+            batch=config.VERSION_SCAN_BATCH,
+            cancelled=progress.cancelled
+        )
+        progress.scanner = scanner
+        index_key = VersionIndex.key(MapTileGrid.from_georect(rect, zoom, direction, current_version))
+        index_entry = version_index.get(index_key)
+        if index_entry:
+            print(f"History of this area is known through version {index_entry['current']}, only newer ones need scanning...")
+            scanner.seed(index_entry)
+
+        versions = scanner.scan(current_version)
+        if not versions:
+            print(f"Couldn't download the current version, not to mention any previous ones – either your connection's wonky or imagery plain doesn't exist for the selected area at the computed zoom level.")
+        else:
+            print(f"Found {len(versions)} distinct versions after {scanner.probes} probes: {versions}")
+            version_index.put(index_key, scanner.to_entry())
+
+        progress.versions = list(versions)
+        progress.phase = "downloading"
+
         downloaded_images = []
-        skipped_versions = 0
-        identical_versions = 0
-        for version in range(current_version, -1, -1):
+        for version in versions:
+            progress.check()
             try:
                 print(f"Version {version}")
+                progress.current_version = version
 
-                print("Turning rectangle into a grid of map tiles at the required zoom level and for the current version...")
-                grid = MapTileGrid.from_georect(rect, zoom, direction, version)
+                # reuse the grid from the scan if there is one, its corners are
+                # already loaded
+                grid = scanner.grids.get(version) or MapTileGrid.from_georect(rect, zoom, direction, version)
                 print(grid)
+                progress.grid = grid
 
-                # if we're not on the first iteration, check if the imagery differs at the corners
-                if version != current_version:
-                    print("Downloading corner tiles and comparing with previously downloaded version...")
-                    if grid.corners_identical_to(previous_grid):
-                        identical_versions += 1
-                        
-                        if identical_versions >= 3:
-                            print("Imagery seems identical, going to next version instead of downloading this one...")
-                            continue
-                    print("They're different! So:")
-
-                previous_grid = grid
-
-                print("Downloading tiles...")
-                grid.download()
-
-                print("Stitching tiles together into an image...")
-                grid.stitch()
-                image = MapTileImage(grid.image, version)
-
-                print("Cropping image to match the chosen area width and height...")
+                print("Downloading tiles and stitching them into an image cropped to the chosen area as they arrive...")
                 print((width, height))
-                image.crop(zoom, direction, rect)
+                stitcher = StreamingStitcher(grid, zoom, direction, rect)
+                grid.download(on_load=stitcher.paste, cancelled=progress.cancelled)
+                image = MapTileImage(stitcher.image, version)
 
                 if image_width is not None or image_height is not None:
                     print("Scaling image...")
@@ -796,7 +1294,7 @@ class SatelliteDownloader:
                     print("Saving image to disk...")
 
                     # Create a directory for the image if it doesn't exist
-                    os.makedirs(f"data/{image_id}", exist_ok=True)
+                    os.makedirs(os.path.join(config.DATA_DIR, str(image_id)), exist_ok=True)
 
                     image_path = (image_path_template + ".jpg").format(
                         image_id=image_id,
@@ -819,57 +1317,51 @@ class SatelliteDownloader:
 
                 # keep track of downloaded images for gif writing
                 downloaded_images.append(image)
-
-                # reset skipped versions counter
-                skipped_versions = 0
-        
-                # return downloaded_images
+                progress.completed_versions.append(version)
+
+                if on_image is not None:
+                    on_image(image_id, image, {
+                        "name": os.path.basename(image.path) if image.path else None,
+                        "version": version,
+                        "zoom": zoom,
+                        "x": [grid.at(0, 0).x, grid.at(0, 0).x + grid.width],
+                        "y": [grid.at(0, 0).y, grid.at(0, 0).y + grid.height],
+                        "versions": progress.versions,
+                    })
 
             except MissingTilesError as e:
-
-                # provide a good error message if not even the ostensibly-current
-                # version could be downloaded
-                if version == current_version:
-                    print(f"Couldn't download the current version, not to mention any previous ones – either your connection's wonky or imagery plain doesn't exist for the selected area at the computed zoom level.")
-                    break
-
-                # try skipping to an older version in case an intermediate one has been removed
-                if skipped_versions < 3:
-                    print(f"Couldn't download version {version}, skipping...")
-                    skipped_versions += 1
-                    continue
-
-                # otherwise, exit with some semblance of grace
-                print(f"It appears as though versions {version + skipped_versions} through {version} (and probably more) have been purged, or your internet connection has (at least partially) disappeared – either way, this seems to be the end of the line.")
-
-                if output_format != "jpeg" or output_format != "jpegs":
-
-                    # reverse downloaded images list to proceed from oldest to newest
-                    downloaded_images.reverse()
-
-                    # Create a directory for the image if it doesn't exist
-                    os.makedirs(f"data/{image_id}", exist_ok=True)
-
-                    print("Skipping GIF...")
-                    # image_path = (image_path_template + ".gif").format(
-                    #     image_id=image_id,
-                    #     datetime=datetime.today().strftime("%Y-%m-%dT%H.%M.%S"),
-                    #     direction="downward",
-                    #     versions=",".join(map(lambda i: str(i.version), downloaded_images)),
-                    #     xmin=grid.at(0, 0).x,
-                    #     xmax=grid.at(0, 0).x+grid.width,
-                    #     ymin=grid.at(0, 0).y,
-                    #     ymax=grid.at(0, 0).y+grid.height,
-                    #     zoom=zoom,
-                    #     latitude=p.lat,
-                    #     longitude=p.lon,
-                    #     width=width,
-                    #     height=height
-                    # )
-                    # downloaded_images[0].image.save(image_path, append_images=[i.image for i in downloaded_images[1:]], save_all=True, duration=1000/framerate, loop=0)
-                    # print(image_path)
-
-                print("All done! 🛰")
-
-                # exit the loop (thereby terminate the program)
-                return image_id, downloaded_images
+                print(f"Couldn't download version {version} despite its corners being available, skipping...")
+
+        if output_format != "jpeg" or output_format != "jpegs":
+
+            # reverse downloaded images list to proceed from oldest to newest
+            downloaded_images.reverse()
+
+            # Create a directory for the image if it doesn't exist
+            os.makedirs(os.path.join(config.DATA_DIR, str(image_id)), exist_ok=True)
+
+            print("Skipping GIF...")
+            # image_path = (image_path_template + ".gif").format(
+            #     image_id=image_id,
+            #     datetime=datetime.today().strftime("%Y-%m-%dT%H.%M.%S"),
+            #     direction="downward",
+            #     versions=",".join(map(lambda i: str(i.version), downloaded_images)),
+            #     xmin=grid.at(0, 0).x,
+            #     xmax=grid.at(0, 0).x+grid.width,
+            #     ymin=grid.at(0, 0).y,
+            #     ymax=grid.at(0, 0).y+grid.height,
+            #     zoom=zoom,
+            #     latitude=p.lat,
+            #     longitude=p.lon,
+            #     width=width,
+            #     height=height
+            # )
+            # downloaded_images[0].image.save(image_path, append_images=[i.image for i in downloaded_images[1:]], save_all=True, duration=1000/framerate, loop=0)
+            # print(image_path)
+
+        progress.current_version = None
+        progress.grid = None
+        progress.phase = "done"
+        print("All done! 🛰")
+
+        return image_id, downloaded_images
@@ -0,0 +1,103 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent async calls: while a call for a key is in
+    flight, further calls for it await the same task instead of starting
+    their own, and its result is reused for `ttl` seconds after it completes.
+    Failures (exceptions, or results `cacheable` rejects) aren't reused. The
+    shared task is shielded, so a caller going away doesn't cancel it for the
+    others. Must be used from a single event loop.
+
+    Results are kept as `keep(result)` returns them (e.g. without bulky
+    parts that can be loaded again), at most `max_entries` of them, the
+    least recently used of which are dropped first.
+    """
+
+    def __init__(self, ttl, cacheable=None, max_entries=None, keep=None):
+        self.ttl = ttl
+        self.cacheable = cacheable or (lambda result: True)
+        self.max_entries = max_entries
+        self.keep = keep or (lambda result: result)
+
+        self._tasks = {}
+        # tasks in flight when the results were cleared, whose results are stale
+        self._stale = set()
+        # key -> (finished at, result), from least to most recently used
+        self._results = OrderedDict()
+
+        self.calls = 0
+        self.coalesced = 0
+        self.reused = 0
+
+    def __repr__(self):
+        return f"SingleFlight({len(self._tasks)} in flight, {len(self._results)} results)"
+
+    async def run(self, key, fn):
+        """Returns the result of `await fn()`, sharing it between callers of the same key."""
+
+        self.calls += 1
+
+        cached = self._results.get(key)
+        if cached is not None:
+            finished_at, result = cached
+            if time.monotonic() - finished_at <= self.ttl:
+                self._results.move_to_end(key)
+                self.reused += 1
+                return result
+            del self._results[key]
+
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+            task.add_done_callback(lambda task: self._done(key, task))
+        else:
+            self.coalesced += 1
+
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        stale = task in self._stale
+        self._stale.discard(task)
+        if stale or task.cancelled() or task.exception() is not None:
+            return
+
+        result = task.result()
+        if self.cacheable(result):
+            self._results[key] = (time.monotonic(), self.keep(result))
+            self._results.move_to_end(key)
+
+        # drop expired results while we're at it, so they don't pile up
+        now = time.monotonic()
+        for expired in [key for key, (finished_at, _) in self._results.items() if now - finished_at > self.ttl]:
+            del self._results[expired]
+        while self.max_entries is not None and len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def clear(self):
+        """
+        Forgets every result, including those of calls still in flight
+        (which later calls don't join anymore), e.g. once what they were
+        derived from went stale. Returns how many were dropped.
+        """
+
+        self._stale.update(self._tasks.values())
+        self._tasks.clear()
+        dropped = len(self._results)
+        self._results.clear()
+        return dropped
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "reused": self.reused,
+            "in_flight": len(self._tasks),
+            "results": len(self._results),
+        }
@@ -0,0 +1,223 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from config import config
+
+
+class TileCache:
+    """
+    A persistent, content-addressed on-disk cache for map tiles. Tile bytes are
+    stored once per distinct content (many imagery versions share identical
+    tiles) under `blobs/`, while `refs/` maps a tile's coordinates – version,
+    zoom, direction, x and y – to the hash of its content. The total size of
+    all blobs and refs is bounded, with the least recently used blobs being
+    evicted first, along with the refs pointing to them.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.ref_dir = os.path.join(directory, "refs")
+
+        # blob hash -> size in bytes, ordered from least to most recently used
+        self._blobs = OrderedDict()
+        # ref name -> blob hash, and blob hash -> names of the refs to it
+        self._refs = {}
+        self._blob_refs = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.enabled():
+            os.makedirs(self.blob_dir, exist_ok=True)
+            os.makedirs(self.ref_dir, exist_ok=True)
+            self._scan()
+
+    def __repr__(self):
+        return f"TileCache({self.directory}, {self._size}/{self.max_bytes} bytes)"
+
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _scan(self):
+        """
+        Rebuilds the LRU order from disk, using modification times as a proxy
+        for the last access (they're bumped on every cache hit), along with
+        which refs point to which blob. Dangling refs are removed.
+        """
+
+        blobs = []
+        for shard in os.scandir(self.blob_dir):
+            if not shard.is_dir():
+                continue
+            for blob in os.scandir(shard.path):
+                if blob.name.endswith(".tmp"):
+                    continue
+                stat = blob.stat()
+                blobs.append((stat.st_mtime, blob.name, stat.st_size))
+
+        for _, digest, size in sorted(blobs):
+            self._blobs[digest] = size
+            self._size += size
+
+        for shard in os.scandir(self.ref_dir):
+            if not shard.is_dir():
+                continue
+            for ref in os.scandir(shard.path):
+                if ref.name.endswith(".tmp"):
+                    continue
+                with open(ref.path, "r") as f:
+                    digest = f.read().strip()
+                if digest in self._blobs:
+                    self._add_ref(ref.name, digest)
+                else:
+                    os.remove(ref.path)
+
+        self._evict()
+
+    @staticmethod
+    def key(maptile):
+        return f"{maptile.version}/{maptile.zoom}/{maptile.direction}/{maptile.x}/{maptile.y}"
+
+    def _ref_name(self, maptile):
+        return hashlib.sha1(self.key(maptile).encode("utf-8")).hexdigest()
+
+    def _ref_path(self, name):
+        return os.path.join(self.ref_dir, name[:2], name)
+
+    def _blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest)
+
+    @staticmethod
+    def _write_atomically(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, maptile):
+        """
+        Returns the cached bytes of a tile, or `None` on a miss. Dangling refs
+        (whose blob has since been evicted) count as misses and are removed.
+        """
+
+        if not self.enabled():
+            return None
+
+        name = self._ref_name(maptile)
+        ref_path = self._ref_path(name)
+        try:
+            with open(ref_path, "r") as f:
+                digest = f.read().strip()
+            with open(self._blob_path(digest), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                self._drop_ref(name)
+            if os.path.exists(ref_path):
+                os.remove(ref_path)
+            return None
+
+        with self._lock:
+            self.hits += 1
+            if digest in self._blobs:
+                self._blobs.move_to_end(digest)
+        try:
+            os.utime(self._blob_path(digest))
+        except FileNotFoundError:
+            pass  # evicted in the meantime, we've got the bytes anyway
+
+        return data
+
+    def put(self, maptile, data, digest=None):
+        """
+        Stores the bytes of a freshly downloaded tile, under their given hash
+        (if it's already been computed, e.g. the tile's fingerprint).
+        """
+
+        if not self.enabled():
+            return
+
+        digest = digest or hashlib.sha256(data).hexdigest()
+
+        with self._lock:
+            known = digest in self._blobs
+            if known:
+                self._blobs.move_to_end(digest)
+        if not known:
+            self._write_atomically(self._blob_path(digest), data)
+
+        name = self._ref_name(maptile)
+        self._write_atomically(self._ref_path(name), digest.encode("ascii"))
+        with self._lock:
+            if digest not in self._blobs:
+                self._blobs[digest] = len(data)
+                self._size += len(data)
+            self._add_ref(name, digest)
+            self._evict()
+
+    def _add_ref(self, name, digest):
+        previous = self._refs.get(name)
+        if previous == digest:
+            return
+        if previous is not None:
+            self._blob_refs[previous].discard(name)
+        else:
+            self._size += len(digest)
+        self._refs[name] = digest
+        self._blob_refs.setdefault(digest, set()).add(name)
+
+    def _drop_ref(self, name):
+        digest = self._refs.pop(name, None)
+        if digest is not None:
+            self._blob_refs[digest].discard(name)
+            self._size -= len(digest)
+
+    def _evict(self):
+        """
+        Drops least recently used blobs, and the refs pointing to them, until
+        the size quota is met again.
+        """
+
+        while self._size > self.max_bytes and self._blobs:
+            digest, size = self._blobs.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._blob_path(digest))
+            except FileNotFoundError:
+                pass
+
+            for name in self._blob_refs.pop(digest, ()):
+                del self._refs[name]
+                self._size -= len(digest)
+                try:
+                    os.remove(self._ref_path(name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "evictions": self.evictions,
+                "blobs": len(self._blobs),
+                "refs": len(self._refs),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+tile_cache = TileCache(config.TILE_CACHE_DIR, config.TILE_CACHE_MAX_BYTES)
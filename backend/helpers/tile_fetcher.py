@@ -0,0 +1,215 @@
+import asyncio
+import contextlib
+import threading
+import time
+
+import httpx
+
+from config import config, TileFetchMode
+
+from .fetch_control import AdaptiveLimiter, LatencyTracker
+from .tile_session import USER_AGENT, tile_session
+
+
+class AsyncTileFetcher:
+    """
+    An asyncio-based tile download engine. It runs its own event loop in a
+    single background thread, so one global, adaptively tuned limiter bounds
+    the number of tile requests in flight across *all* API requests at once,
+    no matter whether they come from a FastAPI handler (see `load`) or from
+    synchronous code (see `run`). Requests go through one pooled
+    `httpx.AsyncClient` and use the same host sharding and circuit breakers
+    as the threaded `TileSession`. Stragglers can optionally be hedged, see
+    `get`.
+    """
+
+    # responses that settle a tile, i.e. end a hedged race: found or missing
+    COMPLETE_STATUSES = (200, 404)
+
+    def __init__(self, policy):
+        self.policy = policy
+
+        self._loop = None
+        self._thread = None
+        self._client = None
+        self._limiter = None
+        self._latencies = LatencyTracker()
+        self._lock = threading.Lock()
+
+        self.hedged = 0
+        self.hedges_won = 0
+
+    def __repr__(self):
+        return f"AsyncTileFetcher({self._limiter})"
+
+    def _ensure_started(self):
+        """Lazily starts the event loop thread on first use."""
+
+        with self._lock:
+            if self._loop is not None:
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def serve():
+                asyncio.set_event_loop(loop)
+                self._limiter = AdaptiveLimiter(self.policy)
+                self._client = httpx.AsyncClient(
+                    headers={"User-Agent": USER_AGENT},
+                    limits=httpx.Limits(
+                        max_connections=self.policy.max_concurrency,
+                        max_keepalive_connections=self.policy.max_concurrency
+                    ),
+                    timeout=None
+                )
+                ready.set()
+                loop.run_forever()
+
+            self._thread = threading.Thread(target=serve, name="tile-fetcher", daemon=True)
+            self._thread.start()
+            ready.wait()
+
+            self._loop = loop
+            return loop
+
+    def run(self, coro):
+        """
+        Runs a coroutine on the fetcher's event loop and blocks until it's
+        done. Must not be called from the fetcher's own loop.
+        """
+
+        loop = self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    async def load(self, maptiles, on_load=None, cancelled=None):
+        """
+        Loads the given tiles concurrently, calling `on_load` with each one as
+        soon as it's available. Awaitable from any event loop, including
+        FastAPI's, without blocking it. Once the (threading) event `cancelled`
+        is set, all requests still in flight or waiting are abandoned, leaving
+        their tiles as they are.
+        """
+
+        loop = self._ensure_started()
+        if asyncio.get_running_loop() is loop:
+            await self._load_all(maptiles, on_load, cancelled)
+        else:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(self._load_all(maptiles, on_load, cancelled), loop))
+
+    async def _load_all(self, maptiles, on_load, cancelled):
+        loading = asyncio.gather(*[maptile.load_async(on_load) for maptile in maptiles])
+        if cancelled is None:
+            await loading
+            return
+
+        # poll for cancellation, which comes from another thread
+        while not loading.done():
+            if cancelled.is_set():
+                loading.cancel()
+                # let the requests wind down, and retrieve the outcome lest
+                # asyncio complain it never was
+                with contextlib.suppress(asyncio.CancelledError):
+                    await loading
+                return
+            await asyncio.wait({loading}, timeout=0.1)
+        loading.result()
+
+    async def get(self, maptile):
+        """
+        Fetches a tile, waiting for a free slot first, and feeds the outcome
+        back to the limiter and the host's breaker. Must run on the fetcher's
+        event loop (which `load` takes care of).
+        """
+
+        async with self._limiter:
+            primary = asyncio.ensure_future(self._fetch(maptile, tile_session.next_host()))
+            pending = {primary}
+            try:
+                # hedging: if the request takes longer than most recent ones did,
+                # race it against a duplicate sent to another host
+                delay = None
+                if self.policy.hedge_percentile is not None and len(self._latencies) >= self.policy.hedge_min_samples:
+                    delay = self._latencies.percentile(self.policy.hedge_percentile)
+                if delay is None:
+                    return await primary
+
+                done, pending = await asyncio.wait(pending, timeout=delay)
+                if done:
+                    return primary.result()
+
+                self.hedged += 1
+                hedge = asyncio.ensure_future(self._fetch(maptile, tile_session.next_host()))
+                pending = {primary, hedge}
+                while True:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    # errors (and 429s or 5xxs) don't win the race while the other request may still succeed
+                    completed = [
+                        task for task in done
+                        if task.exception() is None and task.result().status_code in self.COMPLETE_STATUSES
+                    ]
+                    if completed:
+                        if completed[0] is hedge:
+                            self.hedges_won += 1
+                        return completed[0].result()
+                    if not pending:
+                        return done.pop().result()  # the last outcome, raising if it's an error
+            finally:
+                # also when the caller is cancelled while waiting
+                for task in pending:
+                    task.cancel()
+
+    async def _fetch(self, maptile, host):
+        """
+        A single request for a tile, whose outcome is fed back to the
+        limiter, the latency tracker and the host's breaker.
+        """
+
+        start = time.monotonic()
+        try:
+            r = await self._client.get(tile_session.url(maptile, host), timeout=self.policy.timeout)
+        except httpx.TransportError:
+            self._limiter.record(False, time.monotonic() - start)
+            tile_session.report(host, False)
+            raise
+
+        latency = time.monotonic() - start
+        ok = not self.policy.retryable(r.status_code)
+        self._limiter.record(ok, latency)
+        tile_session.report(host, ok)
+        if r.status_code == 200:
+            self._latencies.record(latency)
+        return r
+
+    def stats(self):
+        return {
+            "concurrency": self._limiter.stats() if self._limiter else None,
+            "hedging": {
+                "enabled": self.policy.hedge_percentile is not None,
+                "hedged": self.hedged,
+                "hedges_won": self.hedges_won,
+                "threshold": self._latencies.percentile(self.policy.hedge_percentile or 95),
+            },
+            "hosts": {host: breaker.state() for host, breaker in tile_session.breakers.items()},
+        }
+
+    def close(self):
+        """Closes the HTTP client and stops the event loop thread."""
+
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = None
+
+
+def async_mode():
+    """Whether tiles are fetched by the asyncio engine or a thread pool."""
+
+    return config.TILE_FETCH_MODE == TileFetchMode.ASYNC
+
+
+tile_fetcher = AsyncTileFetcher(config.TILE_FETCH_POLICY)
@@ -0,0 +1,35 @@
+import hashlib
+
+from PIL import Image
+
+
+def exact_hash(data):
+    """
+    A fast hash of a tile's encoded bytes. Identical bytes mean identical
+    pixels, so this identifies tiles without decoding them at all – it's also
+    what the tile cache names its blobs after.
+    """
+
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def perceptual_hash(image):
+    """
+    A 64-bit difference hash (dHash): the image is shrunk to 9x8 grayscale
+    pixels and each bit records whether a pixel is brighter than its right
+    neighbor. Unlike `exact_hash`, it survives re-encoding and slight color
+    shifts, see https://www.hackerfactor.com/blog/?/archives/529-Kind-of-Like-That.html
+    """
+
+    pixels = list(image.convert("L").resize((9, 8), resample=Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
@@ -0,0 +1,121 @@
+import itertools
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import config
+
+from .fetch_control import CircuitBreaker
+
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_3) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.47 Safari/537.36"
+
+
+class TileSession:
+    """
+    A process-wide keep-alive HTTP session for tile downloads. Connections are
+    pooled per host (so only the first tile fetched from a host pays for the
+    TCP and TLS handshakes) and requests are sharded round-robin across the
+    configured tile hosts, i.e. khms0 through khms3 by default, skipping hosts
+    whose circuit breaker is open after repeated failures. Pointing the
+    URL templates and hosts at a local stand-in tile server is enough to
+    exercise this without touching Google's servers.
+    """
+
+    def __init__(self, hosts, url_template, oblique_url_template, pool_size, policy):
+        assert hosts
+
+        self.hosts = list(hosts)
+        self.policy = policy
+        self.breakers = {host: CircuitBreaker(policy.breaker_threshold, policy.breaker_cooldown) for host in self.hosts}
+        self.url_template = url_template
+        self.oblique_url_template = oblique_url_template
+        self.pool_size = 0
+
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+
+        self._host_cycle = itertools.cycle(self.hosts)
+        self._lock = threading.Lock()
+
+        self.ensure_pool_size(pool_size)
+
+    def __repr__(self):
+        return f"TileSession({self.hosts}, pool_size={self.pool_size})"
+
+    def ensure_pool_size(self, workers):
+        """
+        Grows the connection pools such that `workers` threads downloading
+        concurrently can each keep a connection alive. Since the requests are
+        spread evenly across all hosts, each host's pool needs just its share.
+        Pools never shrink, and growing them drops the idle connections of the
+        old ones, which is why this only happens when really required.
+        """
+
+        per_host = -(-workers // len(self.hosts))  # ceiling division
+        with self._lock:
+            if per_host <= self.pool_size:
+                return
+            self.pool_size = per_host
+
+            adapter = HTTPAdapter(pool_connections=len(self.hosts), pool_maxsize=per_host)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+
+    def next_host(self):
+        """
+        The next host in rotation whose breaker allows requests – or, if all
+        of them are open, simply the next one (better than not trying at all).
+        """
+
+        with self._lock:
+            for _ in range(len(self.hosts)):
+                host = next(self._host_cycle)
+                if self.breakers[host].allows():
+                    return host
+            return next(self._host_cycle)
+
+    def report(self, host, ok):
+        """Records the outcome of a request to a host for its breaker."""
+
+        self.breakers[host].record(ok)
+
+    def url(self, maptile, host=None):
+        """Builds the URL of a tile on the given (or the next) host."""
+
+        url_template = self.url_template
+        if maptile.direction.is_oblique():
+            url_template = self.oblique_url_template
+        return url_template.format(
+            host=host or self.next_host(),
+            version=maptile.version,
+            angle=maptile.direction.angle,
+            x=maptile.x,
+            y=maptile.y,
+            zoom=maptile.zoom
+        )
+
+    def get(self, maptile, host=None, **kwargs):
+        """
+        Fetches a tile, reporting the outcome to the host's breaker. Safe to
+        call from many threads at once.
+        """
+
+        host = host or self.next_host()
+        try:
+            r = self.session.get(self.url(maptile, host), **kwargs)
+        except requests.exceptions.RequestException:
+            self.report(host, False)
+            raise
+        self.report(host, not self.policy.retryable(r.status_code))
+        return r
+
+
+tile_session = TileSession(
+    hosts=config.TILE_HOSTS,
+    url_template=config.TILE_URL_TEMPLATE,
+    oblique_url_template=config.TILE_OBLIQUE_URL_TEMPLATE,
+    pool_size=config.TILE_POOL_SIZE,
+    policy=config.TILE_FETCH_POLICY,
+)
@@ -0,0 +1,134 @@
+import math
+
+import numpy as np
+
+from config import config
+
+
+def box_intersections(box, boxes):
+    """The intersection areas of one box with each of `boxes` (N x 4, x1 y1 x2 y2)."""
+
+    width = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    height = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    return width * height
+
+
+def box_areas(boxes):
+    return np.clip(boxes[:, 2] - boxes[:, 0], 0, None) * np.clip(boxes[:, 3] - boxes[:, 1], 0, None)
+
+
+def merge_across_windows(boxes, scores, windows, threshold):
+    """
+    Non-maximum suppression of duplicates across windows: in order of score,
+    every box suppresses the boxes of *other* windows covering at least
+    `threshold` of the smaller one's area (intersection over smaller rather
+    than over union, since an object cut at a seam is a fraction of its whole
+    box), and grows to their union, so the parts of an object cut at a seam
+    make up its box again. Boxes of the same window are left as the model
+    returned them. Returns the merged boxes and the indices of those kept.
+    """
+
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4).copy()
+    scores = np.asarray(scores, dtype=np.float64)
+    windows = np.asarray(windows)
+    areas = box_areas(boxes)
+
+    # the best remaining box is kept and compared against all others at
+    # once, so there are as many iterations as boxes kept
+    remaining = np.argsort(-scores, kind="stable")
+    keep = []
+    while len(remaining):
+        i, remaining = remaining[0], remaining[1:]
+        keep.append(i)
+
+        others = remaining[windows[remaining] != windows[i]]
+        if not len(others):
+            continue
+        overlap = box_intersections(boxes[i], boxes[others]) / np.maximum(np.minimum(areas[i], areas[others]), 1e-9)
+        duplicates = others[overlap >= threshold]
+        if len(duplicates):
+            boxes[i, :2] = np.minimum(boxes[i, :2], boxes[duplicates, :2].min(axis=0))
+            boxes[i, 2:] = np.maximum(boxes[i, 2:], boxes[duplicates, 2:].max(axis=0))
+            areas[i] = box_areas(boxes[i:i + 1])[0]
+            remaining = remaining[~np.isin(remaining, duplicates)]
+
+    keep = np.array(sorted(keep), dtype=np.int64)
+    return boxes[keep], keep
+
+
+class Tiler:
+    """
+    Splits large images into overlapping windows of at most `tile_size`
+    pixels, so that detection runs at a higher effective resolution (small
+    objects such as cars otherwise get lost when the model scales a whole
+    image down) and every call has a bounded payload. Detections are mapped
+    back to image coordinates and merged across windows, see
+    `merge_across_windows`. Images no larger than a window, or a
+    `tile_size` of 0, make for a single window covering the whole image.
+    """
+
+    def __init__(self, tile_size, overlap, merge_threshold):
+        self.tile_size = tile_size
+        # windows need to advance by some pixels
+        self.overlap = min(overlap, tile_size // 2)
+        self.merge_threshold = merge_threshold
+
+    def __repr__(self):
+        return f"Tiler({self.signature})"
+
+    @property
+    def signature(self):
+        """Identifies the tiling, e.g. as part of cache keys, or `None` without tiling."""
+
+        if not self.tile_size:
+            return None
+        return f"tiles={self.tile_size}/{self.overlap}/{self.merge_threshold}"
+
+    def _offsets(self, length):
+        if not self.tile_size or length <= self.tile_size:
+            return [0], length
+        # as few windows as the overlap allows, spread evenly
+        count = math.ceil((length - self.overlap) / (self.tile_size - self.overlap))
+        stride = (length - self.tile_size) / (count - 1)
+        return [round(i * stride) for i in range(count)], self.tile_size
+
+    def windows(self, width, height):
+        """The windows (left, top, right, bottom) covering an image of the given size."""
+
+        xs, tile_width = self._offsets(width)
+        ys, tile_height = self._offsets(height)
+        return [(x, y, x + tile_width, y + tile_height) for y in ys for x in xs]
+
+    def crops(self, image):
+        """The windows of an image along with its crops to them."""
+
+        windows = self.windows(image.width, image.height)
+        if len(windows) == 1:
+            return [(windows[0], image)]
+        return [(window, image.crop(window)) for window in windows]
+
+    def merge(self, windows, boxes_per_window, scores_per_window):
+        """
+        Maps the boxes (x1, y1, x2, y2, in pixels of the window's crop)
+        detected in each window back to the image, and merges duplicates
+        across windows. Returns the boxes (as a list of lists), their scores
+        and the indices of the kept detections in the concatenation of all
+        windows' detections (e.g. to pick their labels).
+        """
+
+        boxes, scores, window_indices = [], [], []
+        for index, (window, window_boxes, window_scores) in enumerate(zip(windows, boxes_per_window, scores_per_window)):
+            for box, score in zip(window_boxes, window_scores):
+                x1, y1, x2, y2 = box
+                boxes.append([x1 + window[0], y1 + window[1], x2 + window[0], y2 + window[1]])
+                scores.append(score)
+                window_indices.append(index)
+
+        if len(windows) == 1 or not boxes:
+            return boxes, scores, list(range(len(boxes)))
+
+        merged, keep = merge_across_windows(boxes, scores, window_indices, self.merge_threshold)
+        return merged.tolist(), [scores[i] for i in keep], keep.tolist()
+
+
+tiler = Tiler(config.ANALYSIS_TILE_SIZE, config.ANALYSIS_TILE_OVERLAP, config.ANALYSIS_TILE_MERGE_THRESHOLD)
@@ -0,0 +1,145 @@
+import base64
+import threading
+from collections import OrderedDict
+
+from config import config
+from PIL import Image
+
+from .analysis_cache import AnalysisCache
+from .annotation_encoding import MEDIA_TYPES, encode_annotation
+
+
+class EncodedUpload:
+    """An image encoded for upload, along with the size it was encoded at."""
+
+    def __init__(self, digest, data, media_type, size):
+        self.digest = digest
+        self.data = data
+        self.media_type = media_type
+        self.size = size
+
+    def __repr__(self):
+        return f"EncodedUpload({self.media_type}, {self.size[0]}x{self.size[1]}, {len(self.data)} bytes)"
+
+    @property
+    def data_uri(self):
+        return f"data:{self.media_type};base64,{base64.b64encode(self.data).decode()}"
+
+
+class UploadEncoder:
+    """
+    Encodes images for inference APIs as small as they can be without
+    hurting detection much: downscaled to at most `max_dimension` pixels on
+    their longer side, as JPEG or WebP at `quality` – lowered (down to
+    `MIN_QUALITY`) and then downscaled further until the encoded image fits
+    `max_bytes`, if set. Encoded images are kept in an LRU bounded by
+    `cache_max_bytes`, by the hash of their pixels, so an image analyzed
+    again (e.g. with another prompt) isn't encoded again.
+    """
+
+    MIN_QUALITY = 30
+    QUALITY_STEP = 15
+    DOWNSCALE_STEP = 0.75
+
+    def __init__(self, max_dimension, max_bytes, format, quality, cache_max_bytes):
+        self.max_dimension = max_dimension
+        self.max_bytes = max_bytes
+        self.format = format
+        self.quality = quality
+        self.cache_max_bytes = cache_max_bytes
+
+        # content hash -> EncodedUpload, from least to most recently used
+        self._cache = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_encoded = 0
+
+    def __repr__(self):
+        return f"UploadEncoder({self.format.value}, {self.max_dimension}px, {self.max_bytes} bytes)"
+
+    @property
+    def signature(self):
+        """Identifies the encoding settings, e.g. as part of cache keys, since they change what a model sees."""
+
+        return f"upload={self.format.value}/{self.quality}/{self.max_dimension}/{self.max_bytes}"
+
+    def encode(self, image):
+        digest = AnalysisCache.content_hash(image)
+        with self._lock:
+            upload = self._cache.get(digest)
+            if upload is not None:
+                self._cache.move_to_end(digest)
+                self.hits += 1
+                return upload
+            self.misses += 1
+
+        upload = self._encode(image, digest)
+        self.bytes_encoded += len(upload.data)
+        self._keep(upload)
+        return upload
+
+    def _encode(self, image, digest):
+        # JPEG doesn't support transparency, so composite it onto white
+        if image.mode in ("RGBA", "LA", "P"):
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.split()[-1])
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        if self.max_dimension and max(image.size) > self.max_dimension:
+            image = image.copy()
+            image.thumbnail((self.max_dimension, self.max_dimension), Image.LANCZOS)
+
+        quality = self.quality
+        while True:
+            data = encode_annotation(image, self.format, quality)
+            if not self.max_bytes or len(data) <= self.max_bytes or max(image.size) <= 256:
+                return EncodedUpload(digest, data, MEDIA_TYPES[self.format], image.size)
+
+            # trade quality for size first, then resolution
+            if quality > self.MIN_QUALITY:
+                quality = max(self.MIN_QUALITY, quality - self.QUALITY_STEP)
+            else:
+                quality = self.quality
+                image = image.resize(
+                    (round(image.width * self.DOWNSCALE_STEP), round(image.height * self.DOWNSCALE_STEP)),
+                    Image.LANCZOS,
+                )
+
+    def _keep(self, upload):
+        nbytes = len(upload.data)
+        if nbytes > self.cache_max_bytes:
+            return
+
+        with self._lock:
+            if upload.digest in self._cache:
+                return
+            self._cache[upload.digest] = upload
+            self._size += nbytes
+
+            while self._size > self.cache_max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._size -= len(evicted.data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "format": self.format.value,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes_encoded": self.bytes_encoded,
+                "cached": len(self._cache),
+                "size_bytes": self._size,
+            }
+
+
+upload_encoder = UploadEncoder(
+    config.MAX_IMAGE_DIMENSION,
+    config.REPLICATE_UPLOAD_MAX_BYTES,
+    config.REPLICATE_UPLOAD_FORMAT,
+    config.IMAGE_QUALITY,
+    config.REPLICATE_UPLOAD_CACHE_BYTES,
+)
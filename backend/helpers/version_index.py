@@ -0,0 +1,65 @@
+import hashlib
+import json
+import os
+import threading
+
+from config import config
+
+
+class VersionIndex:
+    """
+    A persistent index of the imagery version history of each scanned region,
+    so that only versions newer than the last scan ever need probing again.
+    Regions are keyed by view direction, zoom level, the quadkey of their
+    top-left tile and their size in tiles. Each entry holds the newest version
+    scanned, where the history ends, and the version ranges sharing the same
+    corner tile signature (see `VersionScanner.to_entry`).
+    """
+
+    # bump whenever the entry format or the signatures within change
+    FORMAT = 2
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"VersionIndex({self.directory})"
+
+    @staticmethod
+    def key(grid):
+        origin = grid.at(0, 0)
+        return f"{origin.direction}/{origin.zoom}/{origin.quadkey()}/{grid.width}x{grid.height}"
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{name}.json")
+
+    def get(self, key):
+        """Returns the entry for a region, or `None` if it's unknown."""
+
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+        if entry.get("format") != self.FORMAT or entry.get("key") != key:
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """Replaces the entry for a region."""
+
+        entry = dict(entry, format=self.FORMAT, key=key)
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with self._lock:
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+
+
+version_index = VersionIndex(config.VERSION_INDEX_DIR)
@@ -0,0 +1,132 @@
+import json
+import os
+import re
+import threading
+import time
+
+import requests
+
+from config import config
+
+from .tile_session import USER_AGENT
+
+
+DEFAULT_VERSION = 908
+DEFAULT_OBLIQUE_VERSION = 131  # both as of early October, 2021
+
+
+class VersionResolver:
+    """
+    Resolves the current Google Maps imagery versions (one for the downward,
+    one for the oblique view) by scanning the Maps JavaScript API loader for
+    its tile URLs. The result is cached process-wide for `ttl` seconds and
+    refreshed in a background thread once it's gone stale, so callers never
+    wait for the page – they get the last known good versions instead, which
+    also survive restarts and failed refreshes. Only without any (i.e. on a
+    fresh deploy) is the page waited for once, see `warm_up`, rather than
+    falling back to hardcoded versions years out of date.
+    """
+
+    PATTERNS = {
+        False: rb'null,\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)',
+        True: rb'\],\[\[\"https:\/\/khms0\.googleapis\.com\/kh\?v=([0-9]+)',
+    }
+
+    def __init__(self, url, ttl, state_path, retry_interval=60):
+        self.url = url
+        self.ttl = ttl
+        self.state_path = state_path
+        self.retry_interval = retry_interval
+
+        # oblique -> last known good version
+        self._versions = {False: DEFAULT_VERSION, True: DEFAULT_OBLIQUE_VERSION}
+        # whether the versions were resolved (now or before a restart) at all
+        self._known = False
+        self._expires_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+        self._load_state()
+
+    def __repr__(self):
+        return f"VersionResolver({self.url}, {self._versions})"
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+            self._versions[False] = state["downward"]
+            self._versions[True] = state["oblique"]
+            self._known = True
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+
+    def _save_state(self):
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"downward": self._versions[False], "oblique": self._versions[True]}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def warm_up(self, timeout):
+        """
+        Resolves the versions right away, waiting at most `timeout` seconds
+        for the page, if no good ones are known yet – otherwise refreshes
+        them in the background as usual.
+        """
+
+        with self._lock:
+            known = self._known or self._refreshing
+            if not known:
+                self._refreshing = True
+        if known:
+            self.current_version()
+        else:
+            self.refresh(timeout)
+
+    def current_version(self, oblique=False):
+        """
+        Returns the current (or last known good) version without blocking,
+        kicking off a background refresh if the cached one has expired.
+        """
+
+        with self._lock:
+            if time.monotonic() >= self._expires_at and not self._refreshing:
+                self._refreshing = True
+                threading.Thread(target=self.refresh, name="version-resolver", daemon=True).start()
+            return self._versions[oblique]
+
+    def refresh(self, timeout=10):
+        """
+        Fetches the page and updates whichever versions could be extracted.
+        After a failure, another attempt is made `retry_interval` seconds
+        later rather than once the full TTL has passed.
+        """
+
+        ttl = self.retry_interval
+        try:
+            page = requests.get(self.url, headers={"User-Agent": USER_AGENT}, timeout=timeout).content
+            matches = {oblique: re.search(pattern, page) for oblique, pattern in self.PATTERNS.items()}
+            matches = {oblique: match for oblique, match in matches.items() if match}
+            if matches:
+                with self._lock:
+                    for oblique, match in matches.items():
+                        self._versions[oblique] = int(match.group(1).decode("ascii"))
+                    self._known = True
+                    self._save_state()
+                ttl = self.ttl
+            else:
+                print(f"Unable to extract current version, proceeding with {self._versions} instead.")
+        except requests.RequestException:
+            print(f"Unable to load Google Maps, proceeding with {self._versions} instead.")
+        finally:
+            with self._lock:
+                self._expires_at = time.monotonic() + ttl
+                self._refreshing = False
+
+
+version_resolver = VersionResolver(
+    url=config.MAPS_JS_URL,
+    ttl=config.VERSION_TTL_SECONDS,
+    state_path=config.VERSION_STATE_PATH,
+)
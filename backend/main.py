@@ -1,109 +1,246 @@
+import asyncio
 import base64
 import os
-from io import BytesIO
+import shutil
 
-from config import config
+from config import AnnotationFormat, config
+from helpers.analysis_cache import analysis_cache
 from helpers.analyzer_factory import create_analyzer
-from helpers.satellite_downloader import SatelliteDownloader
-from PIL import Image
+from helpers.derivatives import derivatives
+from helpers.download_jobs import DownloadJobState, download_jobs
+from helpers.image_store import image_store
+from helpers.satellite_downloader import DownloadCancelled, DownloadProgress, SatelliteDownloader
+from helpers.single_flight import SingleFlight
 
 
 class SatelliteBackend:
 
     def __init__(self):
-        self.images_db = {}
-        self.image_names = {}
         self.satellite_downloader = SatelliteDownloader()
         
         # Use factory to get appropriate analyzer
         self.satellite_analyzer = create_analyzer()
+        # Detections cached for a previous version of the model are stale (the
+        # other analyzer's are kept, for switching back)
+        analysis_cache.retain_model(self.satellite_analyzer.MODEL_VERSION, self.satellite_analyzer.MODEL_FAMILY)
+
+        # Identical concurrent analyses share one run, repeats reuse its result
+        # (unless any image's analysis failed), without the annotated images'
+        # bytes, which are read from disk again
+        self.analyses = SingleFlight(
+            config.ANALYSIS_RESULT_TTL_SECONDS,
+            cacheable=lambda result: "error" not in result and not any("error" in r for r in result["results"]),
+            max_entries=config.ANALYSIS_RESULT_MAX_ENTRIES,
+            keep=lambda result: {
+                **result,
+                "results": [{k: v for k, v in r.items() if k != "image_bytes"} for r in result["results"]],
+            },
+        )
         
-        # Read all existing images from filesystem
-        data_dir = config.DATA_DIR
-        if not os.path.exists(data_dir):
-            os.makedirs(data_dir, exist_ok=True)
-            self.image_ids = []
-        else:
-            self.image_ids = [f.name for f in os.scandir(data_dir) if f.is_dir()]
-
-        # Load images into memory (these are already PIL images from disk)
-        for image_id in self.image_ids:
-            image_dir = f"{data_dir}/{image_id}"
-            if os.path.exists(image_dir):
-                image_files = [file for file in os.scandir(image_dir) if file.name.endswith(('.jpg', '.jpeg', '.png'))]
-                images = [Image.open(f"{image_dir}/{file.name}") for file in image_files]
-                self.images_db[image_id] = images
-                self.image_names[image_id] = [file.name for file in image_files]
-
-    def download_satellite_images(self, latitude: float, longitude: float, zoom: int):
-        """
-        Download satellite images for given coordinates.
-        """
-        image_id, images = self.satellite_downloader.download(latitude, longitude, zoom)
-
-        # Extract PIL images from MapTileImage wrappers
-        pil_images = [img.image if hasattr(img, 'image') else img for img in images]
-        self.images_db[str(image_id)] = pil_images
-        
-        # Get image names from downloaded images
-        image_dir = f"{config.DATA_DIR}/{image_id}"
-        if os.path.exists(image_dir):
-            self.image_names[str(image_id)] = [f.name for f in os.scandir(image_dir) if f.name.endswith(('.jpg', '.jpeg', '.png'))]
+        # Images on disk are indexed up front but only decoded on demand
+        self.image_store = image_store
+
+    def download_satellite_images(self, latitude: float, longitude: float, zoom: int, progress: DownloadProgress = None, on_image=None):
+        """
+        Download satellite images for given coordinates. If the download gets
+        cancelled through `progress`, whatever was saved so far is removed.
+        """
+        progress = progress or DownloadProgress()
+        try:
+            image_id, images = self.satellite_downloader.download(latitude, longitude, zoom, progress, on_image)
+        except DownloadCancelled:
+            if progress.image_id:
+                shutil.rmtree(f"{config.DATA_DIR}/{progress.image_id}", ignore_errors=True)
+            raise
+
+        # Record the saved images in the manifest, keeping the PIL images from
+        # the MapTileImage wrappers decoded (as far as the memory budget allows)
+        saved = [img for img in images if img.path]
+        self.image_store.add(
+            str(image_id),
+            [{
+                "name": os.path.basename(img.path),
+                "version": img.version,
+                "width": img.image.width,
+                "height": img.image.height,
+                "latitude": latitude,
+                "longitude": longitude,
+                "zoom": zoom,
+            } for img in saved],
+            {os.path.basename(img.path): img.image for img in saved},
+        )
 
-        # Use original images for tobytes (MapTileImage has custom tobytes method)
-        images_bytes = [image.tobytes() for image in images]
+        # Previews are generated in the background, from the images at hand
+        for img in saved:
+            derivatives.schedule(img.path, img.image)
 
+        # The images are delivered from disk in whichever format the client
+        # asks for, see `encoded_images`
         return {
             "image_id": str(image_id),
-            "images": images_bytes
         }
 
-    async def analyze_satellite_images(self, image_id: str, analysis_type: str):
+    def encoded_images(self, image_id: str):
+        """
+        The saved images of an image_id as base64 strings, oldest version
+        first, for clients expecting them inline in JSON. They're read as
+        saved rather than encoded again.
+        """
+        return [self.encoded_file(entry["path"]) for entry in self.image_store.entries(image_id)]
+
+    @staticmethod
+    def encoded_file(path: str):
+        """A saved image as a base64 string, as read from disk."""
+        with open(path, "rb") as f:
+            return base64.b64encode(f.read()).decode('utf-8')
+
+    @staticmethod
+    def download_key(latitude: float, longitude: float, zoom: int):
+        """
+        Normalizes download parameters such that requests for (practically)
+        the same area share a key, and thereby one download.
+        """
+        decimals = config.COALESCE_COORDINATE_DECIMALS
+        return (round(latitude, decimals) + 0.0, round(longitude, decimals) + 0.0, zoom)
+
+    def submit_download(self, latitude: float, longitude: float, zoom: int):
+        """
+        Download satellite images for given coordinates as a background job,
+        or attach to the job already downloading (or done with) the same area.
+        """
+        return download_jobs.submit(
+            lambda progress, on_image: self.download_satellite_images(latitude, longitude, zoom, progress, on_image),
+            {"latitude": latitude, "longitude": longitude, "zoom": zoom},
+            key=self.download_key(latitude, longitude, zoom),
+        )
+
+    async def stream_satellite_images(self, latitude: float, longitude: float, zoom: int, progress_interval: float = 2.0):
+        """
+        Download satellite images for given coordinates as a background job,
+        yielding an event for each version's image as soon as it's saved.
+        Events are "job" first, then "image" (and "progress" every
+        `progress_interval` seconds in between), and finally "done" or
+        "error". Closing the generator early cancels the job, unless others
+        are still waiting for it.
+        """
+        job = self.submit_download(latitude, longitude, zoom)
+        try:
+            yield {"event": "job", "job_id": job.id}
+
+            seen = 0
+            while True:
+                images, finished = await asyncio.to_thread(job.wait_for_images, seen, progress_interval)
+                for image_id, path, metadata in images:
+                    image = await asyncio.to_thread(self.encoded_file, path)
+                    yield {"event": "image", "image_id": str(image_id), **metadata, "image": image}
+                seen += len(images)
+
+                if finished:
+                    break
+                if not images:
+                    # streaming counts as polling, so the job isn't considered abandoned
+                    job.touch()
+                    yield {"event": "progress", **job.progress.to_dict()}
+
+            if job.state == DownloadJobState.DONE:
+                yield {"event": "done", "image_id": job.result["image_id"], "versions": job.progress.completed_versions}
+            else:
+                yield {"event": "error", "error": job.error or f"download {job.state}"}
+        finally:
+            download_jobs.cancel(job.id)
+
+    async def analyze_satellite_images(self, image_id: str, analysis_type: str, output_format: AnnotationFormat = None):
+        """
+        Analyze satellite images using configured analyzer (async). Identical
+        concurrent requests are coalesced into one run, whose result is also
+        reused for repeats of it. The annotated images are encoded as
+        `output_format` (by default, as configured), see `encoded_annotation`
+        and `analysis_response`.
+        """
+        output_format = output_format or config.ANNOTATION_FORMAT
+        key = (image_id, analysis_type, config.DEFAULT_BOX_THRESHOLD, config.DEFAULT_TEXT_THRESHOLD, output_format)
+        return await self.analyses.run(key, lambda: self._analyze_satellite_images(image_id, analysis_type, output_format))
+
+    async def _analyze_satellite_images(self, image_id: str, analysis_type: str, output_format: AnnotationFormat):
         """
-        Analyze satellite images using configured analyzer (async).
-        Images in database are PIL Image.Image objects (extracted from MapTileImage wrappers).
+        Images in the store are PIL Image.Image objects, decoded on demand.
         """
-        if image_id not in self.images_db:
+        if image_id not in self.image_store:
             return {"error": "Image not found"}
 
-        images = self.images_db[image_id]  # PIL Image.Image objects
-        image_names = self.image_names.get(image_id, [f"image_{i}" for i in range(len(images))])
+        # decoding may take a while, so keep it off the event loop
+        images = await asyncio.to_thread(self.image_store.images, image_id)
+        image_names = self.image_store.names(image_id)
 
         os.makedirs(f"{config.PROCESSED_DATA_DIR}/{image_id}", exist_ok=True)
 
-        # Call async analyzer
-        processed_image_paths = await self.satellite_analyzer.analyze_images(
+        # Call async analyzer, which returns the annotated images encoded
+        results = await self.satellite_analyzer.analyze_images(
             images=images,
             analysis_type=analysis_type,
             image_id=image_id,
             image_names=image_names,
             box_threshold=config.DEFAULT_BOX_THRESHOLD,
             text_threshold=config.DEFAULT_TEXT_THRESHOLD,
+            output_format=output_format,
+            output_quality=config.ANNOTATION_QUALITY,
         )
+        for result in results:
+            if result.get("image_path"):
+                derivatives.schedule(result["image_path"])
+
+        return {
+            "image_id": image_id,
+            "results": results,
+        }
+
+    def analysis_response(self, analysis: dict, image_url=None):
+        """
+        Convert an analysis to its JSON response: the counts and boxes along
+        with the annotated images, either inline (see `encoded_annotation`)
+        or, given `image_url(path)`, as links to the saved files. Images
+        whose analysis failed have `None` for all of them, and an error.
+        """
+        if "error" in analysis:
+            return analysis
 
-        # Load processed images and convert to JSON-safe format
         processed_images = []
-        for processed_path_info in processed_image_paths:
+        for result in analysis["results"]:
+            if "error" in result:
+                # this image's analysis failed, see "errors"
+                processed_images.append(None)
+                continue
             try:
-                img = Image.open(processed_path_info["image_path"])
-                processed_images.append(self.image_to_json_safe(img))
+                if image_url is not None:
+                    processed_images.append(image_url(result["image_path"]))
+                else:
+                    processed_images.append(self.encoded_annotation(result))
             except Exception as e:
                 print(f"Error loading processed image: {e}")
                 processed_images.append(None)
 
-        counts = [result["count"] for result in processed_image_paths]
-
         return {
-            "image_id": image_id,
+            "image_id": analysis["image_id"],
             "processed_images": processed_images,
-            "counts": counts
+            "counts": [result["count"] for result in analysis["results"]],
+            "boxes": [result.get("boxes") for result in analysis["results"]],
+            "errors": [result.get("error") for result in analysis["results"]],
         }
 
-    def image_to_json_safe(self, pil_image: Image.Image) -> str:
+    def encoded_annotation(self, result: dict) -> str:
         """
-        Convert PIL image to base64 string for JSON serialization.
+        The annotated image of an analysis result as base64, taken from the
+        bytes the analyzer encoded (or saved) rather than encoding it again.
+        PNGs stay plain base64 as existing clients expect, other formats
+        become data URLs carrying their MIME type.
         """
-        buffered = BytesIO()
-        pil_image.save(buffered, format="PNG")
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')
-        return img_str
\ No newline at end of file
+        data = result.get("image_bytes")
+        if data is None:
+            with open(result["image_path"], "rb") as f:
+                data = f.read()
+
+        img_str = base64.b64encode(data).decode('utf-8')
+        media_type = result.get("media_type", "image/png")
+        if media_type == "image/png":
+            return img_str
+        return f"data:{media_type};base64,{img_str}"
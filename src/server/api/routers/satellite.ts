@@ -79,13 +79,20 @@ export const satelliteRouter = createTRPCRouter({
           type: input.type,
         });
 
-        const timeSeriesData = result.counts.map((value: number, index: number) => ({
+        // Images whose analysis failed (see `errors`) are left out, keeping
+        // the others' positions in the series for their timestamps
+        const analyzed = result.counts.flatMap((value, index) => {
+          const image = result.processed_images[index];
+          return value === null || !image ? [] : [{ value, image, index }];
+        });
+
+        const timeSeriesData = analyzed.map(({ value, index }) => ({
           timestamp: new Date(2023, index, 1).getTime(),
           value,
         }));
 
         return {
-          processedImages: result.processed_images,
+          processedImages: analyzed.map(({ image }) => image),
           timeSeriesData,
         };
       } catch (error) {
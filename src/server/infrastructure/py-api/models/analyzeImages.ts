@@ -8,8 +8,11 @@ export const AnalyzeSatelliteImagesQuerySchema = z.object({
 
 export const AnalyzeSatelliteImagesResponseSchema = z.object({
   image_id: z.string(),
-  processed_images: z.array(z.string()), // Changed from Uint8Array to base64String
-  counts: z.array(z.number()),
+  // base64 PNGs, or data URLs for other formats (null where the analysis failed)
+  processed_images: z.array(z.string().nullable()),
+  counts: z.array(z.number().nullable()),
+  boxes: z.array(z.array(z.array(z.number())).nullable()).optional(),
+  errors: z.array(z.string().nullable()).optional(),
 });
 
 export type AnalyzeSatelliteImagesQuery = z.infer<
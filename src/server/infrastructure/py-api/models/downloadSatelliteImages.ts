@@ -12,6 +12,36 @@ export const DownloadSatelliteImagesResponseSchema = z.object({
   images: z.array(z.string()), // Changed from Uint8Array to base64String
 });
 
+// Download Jobs
+export const DownloadJobStateSchema = z.enum([
+  "pending",
+  "running",
+  "done",
+  "failed",
+  "cancelled",
+]);
+
+export const DownloadJobSchema = z.object({
+  job_id: z.string(),
+  state: DownloadJobStateSchema,
+  progress: z.object({
+    phase: z.string(),
+    image_id: z.string().nullable(),
+    probed_versions: z.number(),
+    versions: z.array(z.number()),
+    completed_versions: z.array(z.number()),
+    current_version: z.number().nullable(),
+    current_version_tiles: z
+      .object({
+        downloaded: z.number(),
+        errors: z.number(),
+        total: z.number(),
+      })
+      .nullable(),
+  }),
+  error: z.string().nullable(),
+});
+
 // Derive TypeScript types from Zod schemas
 export type DownloadSatelliteImagesQuery = z.infer<
   typeof DownloadSatelliteImagesQuerySchema
@@ -19,3 +49,4 @@ export type DownloadSatelliteImagesQuery = z.infer<
 export type DownloadSatelliteImagesResponse = z.infer<
   typeof DownloadSatelliteImagesResponseSchema
 >;
+export type DownloadJob = z.infer<typeof DownloadJobSchema>;
@@ -6,6 +6,7 @@ import {
   AnalyzeSatelliteImagesResponseSchema,
 } from "./py-api/models/analyzeImages";
 import {
+  DownloadJobSchema,
   type DownloadSatelliteImagesQuery,
   DownloadSatelliteImagesQuerySchema,
   type DownloadSatelliteImagesResponse,
@@ -28,9 +29,14 @@ export class SatelliteApiError extends Error {
 // API Configuration
 const API_CONFIG = {
   baseUrl: env.BACKEND_URL,
-  timeout: 3000000, // 30 seconds
+  timeout: 3000000, // 50 minutes
+  // Download jobs are polled for their status rather than awaited
+  downloadJobTimeout: 600000, // 10 minutes
+  pollInterval: 1000, // 1 second
 } as const;
 
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
 // Helper function to handle API responses
 async function handleApiResponse<T>(
   response: Response,
@@ -70,36 +76,54 @@ export const satelliteApiClient = {
       zoom: validatedParams.zoom.toString(),
     }).toString();
 
-    const controller = new AbortController();
-    const timeoutId = setTimeout(() => controller.abort(), API_CONFIG.timeout);
-
-    try {
-      const response = await fetch(
-        `${API_CONFIG.baseUrl}/downloadSatelliteImages?${queryString}`,
+    // Submit a download job, which returns right away
+    let job = await handleApiResponse(
+      await fetch(
+        `${API_CONFIG.baseUrl}/downloadSatelliteImages/jobs?${queryString}`,
         {
-          signal: controller.signal,
+          method: "POST",
           headers: {
             "Content-Type": "application/json",
           },
-          keepalive: true,
         },
-      );
+      ),
+      DownloadJobSchema,
+    );
+    const jobUrl = `${API_CONFIG.baseUrl}/downloadSatelliteImages/jobs/${job.job_id}`;
+    const deadline = Date.now() + API_CONFIG.downloadJobTimeout;
+
+    try {
+      // Poll its status until it's finished
+      while (job.state === "pending" || job.state === "running") {
+        if (Date.now() > deadline) {
+          throw new SatelliteApiError(
+            "Request timeout",
+            408,
+            "Request took too long to complete",
+          );
+        }
+        await sleep(API_CONFIG.pollInterval);
+        job = await handleApiResponse(await fetch(jobUrl), DownloadJobSchema);
+      }
+
+      if (job.state !== "done") {
+        throw new SatelliteApiError(
+          `Download job ${job.state}`,
+          500,
+          job.error,
+        );
+      }
 
       return await handleApiResponse(
-        response,
+        await fetch(`${jobUrl}/result`),
         DownloadSatelliteImagesResponseSchema,
       );
     } catch (error) {
-      if (error instanceof Error && error.name === "AbortError") {
-        throw new SatelliteApiError(
-          "Request timeout",
-          408,
-          "Request took too long to complete",
-        );
+      // Don't leave the backend downloading tiles no one is waiting for
+      if (job.state === "pending" || job.state === "running") {
+        await fetch(jobUrl, { method: "DELETE" }).catch(() => undefined);
       }
       throw error;
-    } finally {
-      clearTimeout(timeoutId);
     }
   },
 
@@ -110,6 +134,8 @@ export const satelliteApiClient = {
     const queryString = new URLSearchParams({
       analysis_type: validatedParams.type,
       image_id: validatedParams.image_id,
+      // Lossy WebP annotations are a fraction of the size of PNGs
+      image_format: "webp",
     }).toString();
 
     const controller = new AbortController();